@@ -0,0 +1,183 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Literal, Tuple
+from urllib.parse import urlsplit
+
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel, Field
+
+from . import db, replicas
+from .config import settings
+
+# request headers of the batch that do not apply to its sub-requests
+NOT_FORWARDED = {
+    b"content-length",
+    b"content-type",
+    b"accept-encoding",
+    b"if-none-match",
+}
+# connection level keys of the scope, shared by the sub-requests
+SCOPE_KEYS = ("type", "asgi", "http_version", "scheme", "server", "client", "state")
+
+
+class SubRequest(BaseModel):
+    method: Literal["GET", "POST", "PUT", "PATCH", "DELETE"]
+    url: str = Field(description="Path and query string, e.g. `/api/jobs?queue=a`")
+    headers: Dict[str, str] = {}
+    body: Any = None
+
+
+class BatchRequest(BaseModel):
+    requests: List[SubRequest] = Field(max_length=settings.batch_max_requests)
+    atomic: bool = Field(
+        False,
+        description="Commit all the writes or none: the first failure rolls "
+        "back the batch and the following requests are not run",
+    )
+
+
+def _scope(request: Request, sub: SubRequest) -> Dict[str, Any]:
+    url = urlsplit(sub.url)
+    if not url.path.startswith("/api/") or url.scheme or url.netloc:
+        raise HTTPException(400, f"Invalid batch url '{sub.url}'")
+    if url.path == "/api/$batch" or url.path.endswith("/changes"):
+        # nested batches and endless change feeds
+        raise HTTPException(400, f"Not allowed in a batch: '{sub.url}'")
+    overrides = {k.lower().encode(): v.encode() for k, v in sub.headers.items()}
+    headers = [
+        (k, v)
+        for k, v in request.scope["headers"]
+        if k not in NOT_FORWARDED and k not in overrides
+    ]
+    headers += overrides.items()
+    if sub.body is not None:
+        headers.append((b"content-type", b"application/json"))
+    return {
+        **{k: request.scope[k] for k in SCOPE_KEYS if k in request.scope},
+        "root_path": request.scope.get("root_path", ""),
+        "method": sub.method,
+        "path": url.path,
+        "raw_path": url.path.encode(),
+        "query_string": url.query.encode(),
+        "headers": headers,
+    }
+
+
+async def dispatch(request: Request, sub: SubRequest) -> Tuple[int, Dict, bytes]:
+    """Run a sub-request through the application, as if it came on its own."""
+    scope = _scope(request, sub)
+    body = b"" if sub.body is None else json.dumps(sub.body).encode()
+    received = False
+    status = 500
+    headers: Dict[str, str] = {}
+    chunks: List[bytes] = []
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # the batch client is still there until the batch ends
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers.update(
+                (k.decode(), v.decode()) for k, v in message.get("headers", ())
+            )
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await request.app(scope, receive, send)
+    except Exception:
+        # already logged, and answered with a 500, by the error middleware
+        status = 500
+    headers.pop("content-length", None)
+    return status, headers, b"".join(chunks)
+
+
+def _response(status: int, headers: Dict[str, str], body: bytes) -> str:
+    """A sub-response as JSON, a JSON body embedded as is."""
+    content = "null"
+    if body:
+        if headers.get("content-type", "").startswith("application/json"):
+            content = body.decode()
+        else:
+            content = json.dumps(body.decode(errors="replace"))
+    return (
+        f'{{"status": {status}, "headers": {json.dumps(headers)}, '
+        f'"body": {content}}}'
+    )
+
+
+async def endpoint(
+    request: Request, batch: BatchRequest, role: str = Depends(db.get_role)
+):
+    # checked before running anything
+    for sub in batch.requests:
+        _scope(request, sub)
+    responses: List[str] = []
+    failed = False
+    committed = False
+    async with db.engine.connect() as conn:
+        try:
+            # set for the session, so that the sub-requests find it in place
+            await db.set_identity(conn, role)
+            token = db.batch_connection.set(conn)
+            try:
+                for sub in batch.requests:
+                    if failed and batch.atomic:
+                        responses.append(_response(424, {}, b""))
+                        continue
+                    status, sub_headers, body = await dispatch(request, sub)
+                    responses.append(_response(status, sub_headers, body))
+                    if status >= 400:
+                        failed = True
+                        if batch.atomic or sub.method != "GET" or status >= 500:
+                            # drops the writes of the failed request, with
+                            # atomic those of the batch, and the identity set
+                            # meanwhile
+                            await conn.rollback()
+                            conn.info.pop("identity", None)
+                            await db.set_identity(conn, role)
+                    elif sub.method != "GET" and not batch.atomic:
+                        await conn.commit()
+            finally:
+                db.batch_connection.reset(token)
+            if not (failed and batch.atomic):
+                await conn.commit()
+                committed = True
+            headers = await replicas.write_headers(conn)
+        finally:
+            if not committed:
+                # rolled back on release, and with it the identity set in the
+                # last transaction: the pooled connection must not claim it
+                conn.info.pop("identity", None)
+    return Response(
+        content=(
+            f'{{"committed": {json.dumps(committed)}, '
+            f'"responses": [{", ".join(responses)}]}}'
+        ),
+        media_type="application/json",
+        headers=headers if committed else {},
+    )
+
+
+def add_route(app: FastAPI):
+    app.add_api_route(
+        "/api/$batch",
+        endpoint,
+        summary="Run many requests in one round trip",
+        description=(
+            "Sub-requests run in order on a single database connection, reads "
+            "see the writes before them. Each write is committed on its own, "
+            "or all together with `atomic`. Returns the status, headers and body "
+            "of each sub-request, 424 for those not run after a failure."
+        ),
+        operation_id="batch",
+        methods=["POST"],
+        tags=["batch"],
+    )
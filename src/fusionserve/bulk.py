@@ -0,0 +1,310 @@
+import json
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterable, List, Tuple, Type
+
+import asyncpg
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from sqlalchemy import (
+    JSON,
+    ColumnElement,
+    Table,
+    Values,
+    column,
+    delete,
+    insert,
+    literal_column,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import db, metrics
+from .config import settings
+
+# bound parameters accepted by a single statement
+MAX_PARAMETERS = 32767
+
+
+def invalid(e: ValidationError, index: int | None = None) -> HTTPException:
+    prefix = ("body",) if index is None else ("body", index)
+    return HTTPException(
+        422,
+        [
+            {**error, "loc": (*prefix, *error["loc"])}
+            for error in e.errors(
+                include_url=False, include_context=False, include_input=False
+            )
+        ],
+    )
+
+
+def _row(model: BaseModel) -> Dict[str, Any]:
+    # omitted columns get their server default
+    return model.model_dump(exclude_unset=True)
+
+
+async def read_rows(
+    request: Request, model: Type[BaseModel]
+) -> Tuple[bool, AsyncIterator[Dict[str, Any]]]:
+    """Validated rows of a JSON object, a JSON array or an NDJSON body.
+
+    NDJSON is read and validated line by line as the body is received, so its
+    size is not limited by memory. Also returns whether the body was a single
+    object.
+    """
+    media_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if media_type == "application/x-ndjson":
+        return False, _ndjson_rows(request, model)
+    body = await request.body()
+    if body.lstrip()[:1] == b"{":
+        try:
+            row = model.model_validate_json(body)
+        except ValidationError as e:
+            raise invalid(e)
+        return True, _iterate([_row(row)])
+    try:
+        rows = TypeAdapter(List[model]).validate_json(body)
+    except ValidationError as e:
+        raise invalid(e)
+    return False, _iterate([_row(row) for row in rows])
+
+
+async def _iterate(rows: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    for row in rows:
+        yield row
+
+
+async def _ndjson_rows(
+    request: Request, model: Type[BaseModel]
+) -> AsyncIterator[Dict[str, Any]]:
+    buffer = b""
+    index = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                try:
+                    yield _row(model.model_validate_json(line))
+                except ValidationError as e:
+                    raise invalid(e, index)
+                index += 1
+    if buffer.strip():
+        try:
+            yield _row(model.model_validate_json(buffer))
+        except ValidationError as e:
+            raise invalid(e, index)
+
+
+def _join(parts: List[str]) -> str:
+    """Concatenate JSON arrays."""
+    return "[" + ", ".join(part[1:-1] for part in parts if part != "[]") + "]"
+
+
+class BulkInsert:
+    """Insert validated rows into a table, inside the transaction of ``conn``.
+
+    Rows are buffered by the set of columns they provide. Up to
+    ``bulk_copy_threshold`` rows are inserted with multi-row INSERT ...
+    RETURNING statements, and the created rows are returned as JSON. Past
+    the threshold the buffer is written with COPY every ``bulk_copy_threshold``
+    rows, and only the number of created rows is returned: memory use does not
+    depend on the size of the load.
+    """
+
+    def __init__(self, conn: AsyncConnection, table: Table):
+        self.conn = conn
+        self.table = table
+        self.pending: Dict[Tuple[str, ...], List[Dict[str, Any]]] = defaultdict(list)
+        self.buffered = 0
+        self.copying = False
+        self.count = 0
+
+    async def add(self, row: Dict[str, Any]):
+        self.pending[tuple(row)].append(row)
+        self.buffered += 1
+        if self.buffered >= settings.bulk_copy_threshold:
+            self.copying = True
+            await self._flush()
+
+    async def finish(self, single: bool) -> str:
+        """Write the buffered rows, returns the JSON response body."""
+        parts = await self._flush()
+        metrics.record_rows(self.count)
+        if self.copying:
+            return json.dumps({"count": self.count})
+        if single:
+            return parts[0][1:-1]
+        return _join(parts)
+
+    async def _flush(self) -> List[str]:
+        parts = []
+        for columns, rows in self.pending.items():
+            if self.copying and columns:
+                await self._copy(columns, rows)
+            else:
+                parts += await self._insert(columns, rows)
+            self.count += len(rows)
+        self.pending.clear()
+        self.buffered = 0
+        return parts
+
+    async def _insert(self, columns: Tuple[str, ...], rows: List[Dict[str, Any]]):
+        """Insert ``rows`` and return the created rows, one JSON array per batch."""
+        parts = []
+        size = MAX_PARAMETERS // len(columns) if columns else 1
+        for start in range(0, len(rows), size):
+            statement = insert(self.table)
+            if columns:
+                statement = statement.values(rows[start : start + size])
+            inserted = statement.returning(*self.table.columns).cte("inserted")
+            parts.append(await self.conn.scalar(db.json_array(select(*inserted.c))))
+        return parts
+
+    async def _copy(self, columns: Tuple[str, ...], rows: List[Dict[str, Any]]):
+        json_columns = {
+            k for k in columns if isinstance(self.table.columns[k].type, JSON)
+        }
+        records = [
+            tuple(json.dumps(row[k]) if k in json_columns else row[k] for k in columns)
+            for row in rows
+        ]
+        raw = (await self.conn.get_raw_connection()).driver_connection
+        try:
+            async with self.conn.begin_nested():
+                await raw.copy_records_to_table(
+                    self.table.name,
+                    schema_name=self.table.schema,
+                    columns=list(columns),
+                    records=records,
+                )
+        except asyncpg.FeatureNotSupportedError:
+            # COPY FROM is not supported on tables with row level security,
+            # executemany sends multi-row INSERT statements instead
+            await self.conn.execute(insert(self.table), rows)
+
+
+class BulkChange:
+    """Set based UPDATE and DELETE statements, in the transaction of ``conn``.
+
+    Rows are chosen either by a where condition, or by joining a VALUES list of
+    primary keys, with the new values of each row when updating. Every
+    statement changes any number of rows in a single round trip.
+    """
+
+    def __init__(self, conn: AsyncConnection, table: Table, returning: bool):
+        self.conn = conn
+        self.table = table
+        self.returning = returning
+        self.count = 0
+        self.parts: List[str] = []
+
+    async def _execute(self, statement, params: Dict[str, Any] = {}):
+        if self.returning:
+            changed = statement.returning(*self.table.columns).cte("changed")
+            # the count comes with the keys of the last row, unused here
+            statement = db.json_array(
+                select(*changed.c),
+                [(pk, False) for pk in self.table.primary_key.columns],
+            )
+            content, count, _ = (await self.conn.execute(statement, params)).one()
+            self.parts.append(content)
+            self.count += count
+        else:
+            self.count += (await self.conn.execute(statement, params)).rowcount
+
+    def _defaults(self, columns: Iterable[str]) -> Dict[str, Any]:
+        # PUT replaces the whole row: what is not given goes back to its default
+        return {
+            k: literal_column("DEFAULT")
+            for k, column in self.table.columns.items()
+            if k not in columns and not column.primary_key
+        }
+
+    def _keys(
+        self, columns: Tuple[str, ...], rows: List[Tuple], params: Dict[str, Any]
+    ) -> List[Values]:
+        """VALUES lists of ``rows``, split to fit the bound parameter limit.
+
+        The limit is shared with ``params``, bound in the same statements.
+        """
+        size = max((MAX_PARAMETERS - len(params)) // len(columns), 1)
+        return [
+            values(
+                *[column(k, self.table.columns[k].type) for k in columns],
+                name="keys",
+            ).data(rows[start : start + size])
+            for start in range(0, len(rows), size)
+        ]
+
+    async def update(
+        self,
+        conditions: List[ColumnElement],
+        params: Dict[str, Any],
+        row: Dict[str, Any],
+        replace: bool,
+    ):
+        """Set the values of ``row`` on every row matching ``conditions``."""
+        row = row | self._defaults(row) if replace else row
+        if not row:
+            raise HTTPException(400, "No column to update")
+        await self._execute(update(self.table).where(*conditions).values(row), params)
+
+    async def update_keys(
+        self,
+        conditions: List[ColumnElement],
+        params: Dict[str, Any],
+        rows: List[Dict[str, Any]],
+        replace: bool,
+    ):
+        """Update each row by primary key, with its own values."""
+        pks = self.table.primary_key.columns.keys()
+        groups: Dict[Tuple[str, ...], List[Tuple]] = defaultdict(list)
+        for index, row in enumerate(rows):
+            if any(row.get(k) is None for k in pks):
+                raise HTTPException(
+                    422, f"Row {index} lacks the primary key {', '.join(pks)}"
+                )
+            columns = (*pks, *[k for k in row if k not in pks])
+            groups[columns].append(tuple(row[k] for k in columns))
+        for columns, group in groups.items():
+            for keys in self._keys(columns, group, params):
+                changes = {k: keys.c[k] for k in columns if k not in pks}
+                if replace:
+                    changes |= self._defaults(columns)
+                if not changes:
+                    raise HTTPException(400, "No column to update")
+                statement = (
+                    update(self.table)
+                    .where(*[self.table.columns[k] == keys.c[k] for k in pks])
+                    .where(*conditions)
+                    .values(changes)
+                )
+                await self._execute(statement, params)
+
+    async def delete(self, conditions: List[ColumnElement], params: Dict[str, Any]):
+        await self._execute(delete(self.table).where(*conditions), params)
+
+    async def delete_keys(
+        self,
+        conditions: List[ColumnElement],
+        params: Dict[str, Any],
+        keys: List[Tuple],
+    ):
+        pks = tuple(self.table.primary_key.columns.keys())
+        for batch in self._keys(pks, keys, params):
+            statement = (
+                delete(self.table)
+                .where(*[self.table.columns[k] == batch.c[k] for k in pks])
+                .where(*conditions)
+            )
+            await self._execute(statement, params)
+
+    def response(self) -> str:
+        """The changed rows when returning them, otherwise their number."""
+        metrics.record_rows(self.count)
+        if not self.returning:
+            return json.dumps({"count": self.count})
+        return _join(self.parts)
@@ -0,0 +1,317 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, defaultdict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    NamedTuple,
+    Set,
+    Tuple,
+)
+
+from fastapi import Request, Response
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from . import db, metrics, replicas
+from .config import logger as _logger
+from .config import settings
+from .notify import listener
+
+CHANGE_CHANNEL = "fusionserve_change"
+
+# Sends the name of the table changed by a statement, once per transaction
+NOTIFY_CHANGE_FUNCTION = text(
+    f"""
+    CREATE OR REPLACE FUNCTION public.fusionserve_notify_change()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANGE_CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END $$
+    """
+)
+
+UNWATCHED_TABLES = text(
+    """
+    SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = :schema AND c.relkind IN ('r', 'p') AND NOT EXISTS (
+        SELECT FROM pg_trigger t
+        WHERE t.tgrelid = c.oid AND t.tgname = 'fusionserve_change'
+    )
+    """
+)
+
+WATCHED_TABLES = text(
+    """
+    SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_trigger t ON t.tgrelid = c.oid
+    WHERE n.nspname = :schema AND t.tgname = 'fusionserve_change'
+    """
+)
+
+
+class Entry(NamedTuple):
+    content: bytes
+    headers: Dict[str, str]
+    tables: Tuple[str, ...]
+
+
+class ResponseCache:
+    """Response bodies of GET requests, least recently used first out.
+
+    Entries are bounded by the total size of their bodies and are dropped
+    when any of the tables they were read from changes. Each table has a
+    generation, incremented by every change: a response is stored only if
+    its tables did not change while it was being computed, so that a change
+    notified during a request does not leave a stale entry behind. With
+    ``settle`` set, responses are not stored either for ``settle`` seconds
+    after a change of their tables, while replicas may still miss it. Only
+    the ``watched`` tables, those with a change trigger, are cached: changes
+    of the others, made elsewhere, would never invalidate them.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[Hashable, Entry] = OrderedDict()
+        self.keys_by_table: Dict[str, Set[Hashable]] = defaultdict(set)
+        self.generations: Dict[str, int] = defaultdict(int)
+        self.settle = 0.0
+        self.changed_at: Dict[str, float] = {}
+        self.watched: Set[str] = set()
+
+    def get(self, key: Hashable, table: str) -> Entry | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.response_cache_misses.labels(table).inc()
+            metrics.record_cache("miss")
+            return None
+        self.entries.move_to_end(key)
+        metrics.response_cache_hits.labels(table).inc()
+        metrics.record_cache("hit")
+        return entry
+
+    def generation(self, tables: Iterable[str]) -> Tuple[int, ...]:
+        return tuple(self.generations[table] for table in tables)
+
+    def put(
+        self,
+        key: Hashable,
+        entry: Entry,
+        generation: Tuple[int, ...],
+    ):
+        if len(entry.content) > self.max_bytes:
+            return
+        if self.generation(entry.tables) != generation:
+            return
+        if self.settle:
+            now = time.monotonic()
+            changed_at = (self.changed_at.get(t) for t in entry.tables)
+            if any(t is not None and now - t < self.settle for t in changed_at):
+                return
+        self._remove(key)
+        self.entries[key] = entry
+        self.size += len(entry.content)
+        for table in entry.tables:
+            self.keys_by_table[table].add(key)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def invalidate(self, table: str):
+        self.generations[table] += 1
+        self.changed_at[table] = time.monotonic()
+        for key in list(self.keys_by_table.pop(table, ())):
+            self._remove(key)
+
+    def clear(self):
+        for table in list(self.generations) + list(self.keys_by_table):
+            self.generations[table] += 1
+        self.entries.clear()
+        self.keys_by_table.clear()
+        self.size = 0
+
+    def _remove(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry.content)
+        for table in entry.tables:
+            keys = self.keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+
+response_cache = ResponseCache(settings.response_cache_max_bytes)
+metrics.response_cache_bytes.set_function(lambda: response_cache.size)
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the result of the first one.
+
+    The first caller runs the call, the others wait for its result, or its
+    exception. If the first caller is cancelled, e.g. because its client went
+    away, one of the waiting callers runs the call again.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(
+        self, key: Hashable, table: str, call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        while (future := self.calls.get(key)) is not None:
+            metrics.coalesced_requests.labels(table).inc()
+            try:
+                # shielded: a waiting caller being cancelled must not cancel it
+                failed, result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                continue
+            if failed:
+                raise result
+            return result
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            # as a result, not to log it as never retrieved when nobody waits
+            future.set_result((True, e))
+            raise
+        finally:
+            del self.calls[key]
+        future.set_result((False, result))
+        return result
+
+
+single_flight = SingleFlight()
+
+
+def enabled(tables: Iterable[str]) -> bool:
+    """Whether responses read from ``tables`` are cached.
+
+    Never inside a batch that may have written, nor for tables whose changes
+    are not notified.
+    """
+    return (
+        settings.response_cache
+        and db.batch_connection.get() is None
+        and all(table in response_cache.watched for table in tables)
+    )
+
+
+async def shared(key: Hashable, table: str, call: Callable[[], Awaitable[Any]]):
+    """Run ``call`` through single_flight, alone inside a batch."""
+    if db.batch_connection.get() is not None:
+        return await call()
+    return await single_flight.run(key, table, call)
+
+
+def cache_key(request: Request, role: str) -> Hashable:
+    """Route path, role and query string with the parameters sorted.
+
+    And the LSN a read must see, if any: such a read shares neither the queries
+    nor the responses computed before the write, possibly on a lagging replica.
+    """
+    return (
+        request.url.path,
+        role,
+        tuple(sorted(request.query_params.multi_items())),
+        request.headers.get(replicas.LSN_HEADER),
+    )
+
+
+def etag(content: bytes) -> str:
+    return f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+
+
+def conditional_response(request: Request, entry: Entry) -> Response:
+    """The JSON response of ``entry``, or 304 if the client already has it."""
+    tag = etag(entry.content)
+    headers = {**entry.headers, "ETag": tag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if tag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(
+        content=entry.content, media_type="application/json", headers=headers
+    )
+
+
+def cached_response(
+    request: Request,
+    key: Hashable,
+    generation: Tuple[int, ...],
+    content: str | bytes,
+    headers: Dict[str, str],
+    tables: Tuple[str, ...],
+) -> Response:
+    """Store a freshly computed response and answer it, honouring If-None-Match."""
+    if isinstance(content, str):
+        content = content.encode()
+    entry = Entry(content, headers, tables)
+    if enabled(tables):
+        response_cache.put(key, entry, generation)
+    return conditional_response(request, entry)
+
+
+async def install_change_triggers():
+    """Add a statement trigger notifying changes to every table of the schema.
+
+    Then caches the responses of the tables that have one, installed now or
+    beforehand by their owner.
+    """
+    schema = {"schema": settings.pg_app_schema}
+    try:
+        async with db.role_connection(None) as conn:
+            await conn.execute(NOTIFY_CHANGE_FUNCTION)
+            tables = await conn.scalars(UNWATCHED_TABLES, schema)
+            quote = conn.dialect.identifier_preparer.quote
+            for table in tables.all():
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(
+                            text(
+                                "CREATE TRIGGER fusionserve_change "
+                                "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                                f"ON {quote(settings.pg_app_schema)}.{quote(table)} "
+                                "FOR EACH STATEMENT "
+                                "EXECUTE FUNCTION public.fusionserve_notify_change()"
+                            )
+                        )
+                except DBAPIError as e:
+                    # creating triggers requires owning the tables
+                    _logger.warning(f"Unable to install the change trigger: {e}")
+            await conn.commit()
+    except DBAPIError as e:
+        _logger.warning(f"Unable to install the change triggers: {e}")
+    async with db.role_connection(None) as conn:
+        response_cache.watched = set((await conn.scalars(WATCHED_TABLES, schema)).all())
+    unwatched = sorted(set(db.models_registry) - response_cache.watched)
+    if unwatched:
+        _logger.warning(
+            f"Responses not cached, no change trigger on: {', '.join(unwatched)}"
+        )
+
+
+async def start():
+    """Invalidate the cached responses of the tables changed in the database."""
+    await install_change_triggers()
+    await listener.listen(CHANGE_CHANNEL, response_cache.invalidate)
+    # changes made while the connection was down have not been notified
+    listener.on_reconnect.append(response_cache.clear)
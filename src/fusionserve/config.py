@@ -12,6 +12,44 @@ settings = Dynaconf(
         # Validator("rabbit_host", default="rabbitmq"),
         # Validator("pg_host", default="tsportal-pg"),
         Validator("log_level", default="INFO"),
+        Validator("pg_port", default=5432),
+        Validator("pool_size", default=5),
+        Validator("pool_max_overflow", default=10),
+        Validator("pool_timeout", default=30),
+        Validator("pool_recycle", default=-1),
+        Validator("pool_pre_ping", default=True),
+        Validator("pg_statement_cache_size", default=100),
+        Validator("schema_snapshot", default=True),
+        Validator("schema_snapshot_dir", default=".schema_snapshots"),
+        Validator("schema_reload", default=False),
+        Validator("schema_reload_delay", default=1.0),
+        Validator("export_batch_size", default=1000),
+        Validator("statement_cache_size", default=512),
+        Validator("bulk_copy_threshold", default=1000),
+        Validator("response_cache", default=False),
+        Validator("response_cache_max_bytes", default=64 * 1024 * 1024),
+        Validator("graphql_max_depth", default=10),
+        Validator("graphql_max_cost", default=50_000),
+        Validator("graphql_collection_size", default=10),
+        Validator("count_exact_limit", default=10_000),
+        Validator("batch_max_requests", default=100),
+        Validator("server_timing", default=False),
+        Validator("profile_roles", default=[]),
+        Validator("profile_dir", default=".profiles"),
+        Validator("admin_roles", default=[]),
+        Validator("slow_query_threshold", default=1.0),
+        Validator("slow_query_explain_interval", default=600.0),
+        Validator("change_feeds", default=False),
+        Validator("change_feed_queue_size", default=1000),
+        Validator("change_feed_keepalive", default=15.0),
+        Validator("pg_replicas", default=[]),
+        Validator(
+            "replica_selection",
+            default="least_connections",
+            is_in=["least_connections", "round_robin"],
+        ),
+        Validator("replica_max_lag", default=5.0),
+        Validator("replica_check_interval", default=2.0),
     ],
 )
 
@@ -1,53 +1,265 @@
 import asyncio
+import base64
+import binascii
+import decimal
+import json
 from enum import Enum
 import re
+import time
 import uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from inspect import Parameter
+from inspect import signature as inspect_signature
 from datetime import datetime, timedelta
-from typing import Annotated, Any, ClassVar, Dict, List, Literal, Set, Tuple
+from typing import Annotated, Any, ClassVar, Dict, List, Literal, Optional, Set, Tuple
 from zoneinfo import ZoneInfo
 
 import inflect as _inflect
-from fastapi import Depends, FastAPI, Query, Request
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from icecream import ic
-from pydantic import BaseModel, ConfigDict, Field, create_model
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    TypeAdapter,
+    ValidationError,
+    create_model,
+)
 from pydantic.alias_generators import to_camel, to_pascal
 from sqlalchemy import (
+    BigInteger,
     Column,
+    ColumnElement,
+    Integer,
     MetaData,
+    Select,
     Table,
-    create_engine,
+    Text,
+    cast,
+    column,
+    event,
     func,
     insert,
     inspect,
+    literal,
+    null,
+    or_,
+    and_,
+    bindparam,
+    case,
     select,
     text,
+    true,
+    tuple_,
+    URL,
     update,
 )
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, UUID, aggregate_order_by
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.ext.automap import AutomapBase, automap_base
-from sqlalchemy.orm import DeclarativeBase, DeclarativeMeta
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    DeclarativeMeta,
+    RelationshipProperty,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import FromClause
+from starlette.routing import BaseRoute
 
+from . import (
+    bulk,
+    cache,
+    export,
+    feeds,
+    filters,
+    metrics,
+    replicas,
+    slowlog,
+    snapshot,
+)
 from .config import logger as _logger
 from .config import settings
+from .notify import listener
+from .statements import Explain, statement_cache
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long each checkout waits for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.pool_checkout_seconds.observe(elapsed)
+            metrics.record_time("pool", elapsed)
+
+
+RESET_IDENTITY = (
+    "SELECT set_config('role', 'none', false), "
+    "set_config('request.jwt.claims', '', false)"
+)
+
+
+def reset_identity(dbapi_connection, connection_record, reset_state):
+    """Pool event: back to the login role, when a connection is returned.
+
+    Connections are also taken without set_identity(), by the replica checks
+    for instance, and must not run as the role of the request before them.
+    """
+    if connection_record.info.pop("identity", None) is None:
+        return
+    if reset_state.terminate_only or not reset_state.asyncio_safe:
+        # the connection is closed instead
+        return
+    # the rollback on return would revert the reset made in a transaction
+    dbapi_connection.rollback()
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(RESET_IDENTITY)
+    finally:
+        cursor.close()
+    dbapi_connection.commit()
+
 
-engine = create_async_engine(
-    f"postgresql+asyncpg://{settings.pg_user}:{settings.pg_password}@"
-    f"{settings.pg_host}:"
-    f"{'5432'}/{settings.pg_database}",
-    echo=settings.echo_sql,
-    pool_pre_ping=True,
+def create_engine(host: str, port: int):
+    """Engine of the pooled connections to the server at ``host``."""
+    engine = create_async_engine(
+        URL.create(
+            "postgresql+asyncpg",
+            username=settings.pg_user,
+            password=settings.pg_password,
+            host=host,
+            port=port,
+            database=settings.pg_database,
+        ),
+        echo=settings.echo_sql,
+        poolclass=InstrumentedPool,
+        pool_size=settings.pool_size,
+        max_overflow=settings.pool_max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_recycle=settings.pool_recycle,
+        pool_pre_ping=settings.pool_pre_ping,
+        # prepared statements kept by each connection, 0 behind pgbouncer
+        connect_args={
+            "prepared_statement_cache_size": settings.pg_statement_cache_size
+        },
+    )
+    metrics.instrument(engine)
+    event.listen(engine.sync_engine.pool, "reset", reset_identity)
+    return engine
+
+
+engine = create_engine(settings.pg_host, settings.pg_port)
+metrics.pool_checked_out.set_function(lambda: engine.pool.checkedout())
+metrics.pool_idle.set_function(lambda: engine.pool.checkedin())
+metrics.pool_limit.set_function(lambda: engine.pool.size() + settings.pool_max_overflow)
+listener.dsn = engine.url.set(drivername="postgresql").render_as_string(
+    hide_password=False
 )
 
 
-async def get_async_session():
-    async_session = async_sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
+# reads are single statements: without a transaction there is no BEGIN and no
+# ROLLBACK round trip around them
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+SET_IDENTITY = text(
+    "SELECT set_config('role', :role, :local), "
+    "set_config('request.jwt.claims', :claims, :local)"
+)
+
+
+async def set_identity(
+    conn: AsyncConnection,
+    role: str | None,
+    claims: dict | None = None,
+    local: bool = False,
+):
+    """Run the following statements of ``conn`` as ``role``, with ``claims``.
+
+    A role of None is the login role. Role and claims are set together in one
+    statement, and only when the connection does not already carry them: the
+    sub-requests of a batch, run on one connection, set it once. Set for the
+    session, the identity is reset when the connection returns to the pool.
+    Inside a transaction ``local`` must be set, the identity then reverts when
+    the transaction ends.
+    """
+    identity = (role or "none", json.dumps(claims) if claims else "")
+    if conn.info.get("identity", ("none", "")) == identity:
+        return
+    start = time.perf_counter()
+    await conn.execute(
+        SET_IDENTITY, {"role": identity[0], "claims": identity[1], "local": local}
     )
-    async with async_session() as session:
+    metrics.record_time("identity", time.perf_counter() - start)
+    if not local:
+        conn.info["identity"] = identity
+
+
+async def get_role(request: Request) -> str:
+    # TODO: role from jwt or anonymous
+    return "fras.marco"
+
+
+async_session = async_sessionmaker(
+    read_engine, class_=AsyncSession, expire_on_commit=False
+)
+
+
+# connection of the batch request running the current sub-request
+batch_connection: ContextVar[AsyncConnection | None] = ContextVar(
+    "batch_connection", default=None
+)
+
+
+async def get_async_session(request: Request):
+    """Session of the read routes, on a replica when one is up to date."""
+    conn = batch_connection.get()
+    if conn is not None:
+        # reads of a batch see its writes
+        async with AsyncSession(bind=conn, expire_on_commit=False) as session:
+            yield session
+        return
+    async with async_session(bind=replicas.read_engine(request)) as session:
         yield session
 
 
+@asynccontextmanager
+async def role_connection(role: str | None):
+    """A transactional connection running as ``role``.
+
+    Used for work that outlives the request, and with None for the internal
+    work that must run as the login role. Inside a batch, the connection of
+    the batch, already running as the role of the request.
+    """
+    conn = batch_connection.get()
+    if conn is not None and role is not None:
+        yield conn
+        return
+    async with engine.connect() as conn:
+        await set_identity(conn, role, local=True)
+        yield conn
+
+
+async def commit(conn: AsyncConnection) -> Dict[str, str]:
+    """Commit the writes of a request, returns the headers to answer with.
+
+    Writes of a batch are committed by the batch.
+    """
+    if conn is batch_connection.get():
+        return {}
+    await conn.commit()
+    return await replicas.write_headers(conn)
+
+
 class RegistryItem(BaseModel):
     model: Any = None
     get_input: Any = None
@@ -58,20 +270,49 @@ class PaginationParams(BaseModel):
     limit: int = Field(100, alias="__limit",gt=0, le=settings.max_page_lenght)
     offset: int = Field(0, alias="__offset", ge=0)
     order_by: str | None = Field(None, alias="__order_by")
+    filter: str | None = Field(
+        None,
+        alias="__filter",
+        description="OData style condition, e.g. `(a eq 'x' or b ne null) and c lt 2`",
+    )
+    after: str | None = Field(
+        None,
+        alias="__after",
+        description="Opaque cursor taken from the `Link` header of the previous page",
+    )
+    count: Literal["exact", "estimated", "planned"] | None = Field(
+        None,
+        alias="__count",
+        description="Total rows in `X-Total-Count`: `exact`, `planned` by the "
+        "planner, `estimated` counts exactly up to a limit then uses statistics",
+    )
+
+
+class ChangeCount(BaseModel):
+    count: int
+
 
 models_registry: Dict[str, RegistryItem] = {}
+# routes created for each table, replaced when the table is reloaded
+routes_registry: Dict[str, List[BaseRoute]] = {}
+# catalog digest of each table, used to find the tables changed by DDL
+catalog_digests: Dict[str, str] = {}
 Base: AutomapBase = None
 inflect = _inflect.engine()
 inflect.classical(names=0)
 
 
+def python_type_from_column(column: Column) -> type:
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
+
+
 def pydantic_field_from_column(
     column: Column, model_type: Literal["model", "get_input", "create_input"]
 ) -> Tuple[Any, Field]:
-    try:
-        python_type = column.type.python_type
-    except NotImplementedError:
-        python_type = str
+    python_type = python_type_from_column(column)
     field_type = {
         "model": python_type | None if column.nullable else python_type,
         "get_input": python_type | None,
@@ -80,125 +321,1110 @@ def pydantic_field_from_column(
     return (field_type, Field(None, description=column.comment))
 
 
-def introspect():
-    # Introspection is only supported for sync engines
-    _engine = create_engine(
-        f"postgresql+psycopg://{settings.pg_user}:{settings.pg_password}@"
-        f"{settings.pg_host}:"
-        f"{'5432'}/{settings.pg_database}",
-        echo=settings.echo_sql,
-        pool_pre_ping=True,
+def pydantic_fields_from_relationships(
+    base: AutomapBase, table_name: str
+) -> Dict[str, Tuple[Any, Field]]:
+    """Optional fields of the related records that ``__include`` can embed."""
+    fields = {}
+    orm_class = base.classes.get(table_name)
+    if orm_class is None:
+        # not mapped by automap, e.g. an association table
+        return fields
+    for rel in inspect(orm_class).relationships:
+        singular = inflect.singular_noun(rel.mapper.local_table.name)
+        target = to_pascal(f"{singular}_model")
+        field_type = List[target] if rel.uselist else target
+        fields[rel.key] = (
+            Optional[field_type],
+            Field(None, description=f"Included with `__include={rel.key}`"),
+        )
+    return fields
+
+
+async def reflect(
+    conn: AsyncConnection, metadata: MetaData = None, only: List[str] = None
+) -> MetaData:
+    metadata = MetaData() if metadata is None else metadata
+    await conn.run_sync(
+        lambda sync_conn: metadata.reflect(
+            bind=sync_conn, schema=settings.pg_app_schema, only=only
+        )
     )
-    metadata = MetaData()
-    metadata.reflect(bind=_engine, schema=settings.pg_app_schema)
-    global Base
-    Base = automap_base(metadata=metadata)
+    return metadata
+
+
+async def introspect():
+    global Base, catalog_digests
+    metadata = None
+    async with role_connection(None) as conn:
+        digests = await snapshot.table_fingerprints(conn, settings.pg_app_schema)
+        key = snapshot.fingerprint(digests)
+        if settings.schema_snapshot:
+            metadata = snapshot.load(settings.pg_app_schema, key)
+        if metadata is None:
+            metadata = await reflect(conn)
+            if settings.schema_snapshot:
+                snapshot.save(settings.pg_app_schema, key, metadata)
+    Base, registry = build_registry(metadata)
+    models_registry.update(registry)
+    catalog_digests = digests
+
+
+def build_registry(
+    metadata: MetaData, unchanged: Dict[str, RegistryItem] = {}
+) -> Tuple[AutomapBase, Dict[str, RegistryItem]]:
+    """Map the tables of ``metadata`` and create their pydantic models.
+
+    Models of the tables in ``unchanged`` are reused as they are.
+    """
+    base = automap_base(metadata=metadata)
     # calling prepare() just sets up mapped classes and relationships.
-    Base.prepare()
+    base.prepare()
+    registry = {}
     for table in metadata.sorted_tables:
+        if table.name in unchanged:
+            registry[table.name] = unchanged[table.name]
+            continue
         if not inflect.singular_noun(table.name):
             raise ValueError(f"Table name {table.name} is not plural")
         item = RegistryItem()
         for model_type in RegistryItem.model_fields.keys():
+            fields = {
+                k: pydantic_field_from_column(v, model_type)
+                for k, v in table.columns.items()
+            }
+            if model_type == "model":
+                fields |= pydantic_fields_from_relationships(base, table.name)
             setattr(
                 item,
                 model_type,
                 create_model(
                     to_pascal(f"{inflect.singular_noun(table.name)}_{model_type}"),
                     __config__=ConfigDict(from_attributes=True),
-                    **{
-                        k: pydantic_field_from_column(v, model_type)
-                        for k, v in table.columns.items()
-                    },
+                    **fields,
                 ),
             )
-        models_registry[table.name] = item
+        registry[table.name] = item
+    # related models refer to each other by name, resolve them once all exist
+    namespace = {item.model.__name__: item.model for item in registry.values()}
+    for name, item in registry.items():
+        if name not in unchanged:
+            item.model.model_rebuild(_types_namespace=namespace)
+    return base, registry
+
+
+async def reload_routes(app: FastAPI):
+    """Reflect again the tables whose catalog changed and swap their routes.
+
+    Only the changed tables are read from the database, the others are copied
+    from the current metadata. Tables related to a changed one by a foreign key
+    get new routes too, since their mapped relationships point to it. Requests
+    in flight keep running on the objects they started with.
+    """
+    global Base, catalog_digests
+    async with role_connection(None) as conn:
+        digests = await snapshot.table_fingerprints(conn, settings.pg_app_schema)
+        changed = {
+            name
+            for name in digests.keys() | catalog_digests.keys()
+            if digests.get(name) != catalog_digests.get(name)
+        }
+        if not changed:
+            return
+        if "" in changed:
+            # enum labels changed: any column type may be affected
+            changed = set(digests) | set(catalog_digests)
+        changed.discard("")
+        metadata = MetaData()
+        for table in Base.metadata.sorted_tables:
+            if table.name not in changed:
+                table.to_metadata(metadata)
+        metadata = await reflect(
+            conn, metadata, only=[name for name in changed if name in digests]
+        )
+    affected = set(changed)
+    for table in metadata.sorted_tables:
+        # schema.table.column, the referred table may have been dropped
+        referred = {fk.target_fullname.split(".")[-2] for fk in table.foreign_keys}
+        if table.name in changed:
+            affected |= referred
+        elif referred & changed:
+            affected.add(table.name)
+    base, registry = build_registry(
+        metadata,
+        {k: v for k, v in models_registry.items() if k not in affected},
+    )
+    if settings.schema_snapshot:
+        key = snapshot.fingerprint(digests)
+        snapshot.save(settings.pg_app_schema, key, metadata)
+    # from here on nothing awaits, so no request can see a partial swap
+    Base, catalog_digests = base, digests
+    models_registry.clear()
+    models_registry.update(registry)
+    statement_cache.clear()
+    cache.response_cache.clear()
+    old_routes = {id(r) for name in affected for r in routes_registry.pop(name, [])}
+    for name in affected & registry.keys():
+        routes_registry[name] = table_routes(app, name, registry[name])
+    app.router.routes[:] = [r for r in app.router.routes if id(r) not in old_routes]
+    app.openapi_schema = None
+    _logger.info(f"Reloaded tables {', '.join(sorted(affected))}")
+
+
+def parse_include(
+    orm_class: DeclarativeMeta, include: str | None
+) -> List[RelationshipProperty]:
+    """Relationships listed in ``__include`` (``rel1,rel2``).
+
+    They are read from the mapped class of the route, not from the current
+    ``Base``: after a reload, the routes of the tables that did not change
+    keep the table they were created with, and so its relationships.
+    """
+    relationships = inspect(orm_class).relationships
+    included = []
+    for name in filter(None, map(str.strip, (include or "").split(","))):
+        if name not in relationships:
+            raise HTTPException(400, f"Invalid __include relationship '{name}'")
+        if relationships[name] not in included:
+            included.append(relationships[name])
+    return included
+
+
+def included_tables(
+    table: Table, include: List[RelationshipProperty]
+) -> Tuple[str, ...]:
+    """Names of the tables read by a request, for the response cache."""
+    tables = {table.name}
+    for rel in include:
+        tables.add(rel.mapper.local_table.name)
+        if rel.secondary is not None:
+            tables.add(rel.secondary.name)
+    return tuple(sorted(tables))
+
+
+def parse_select(table: Table, columns: str | None) -> Tuple[str, ...] | None:
+    """Column names listed in ``__select`` (``col1,col2``), None for all."""
+    if columns is None:
+        return None
+    names = []
+    for name in filter(None, map(str.strip, columns.split(","))):
+        if name not in table.columns:
+            raise HTTPException(400, f"Invalid __select column '{name}'")
+        if name not in names:
+            names.append(name)
+    if not names:
+        raise HTTPException(400, "Invalid __select, no column given")
+    return tuple(names)
+
+
+def projection(table: Table, columns: Tuple[str, ...] | None) -> List[Column]:
+    """The columns of ``table`` named by parse_select()."""
+    if columns is None:
+        return list(table.columns)
+    return [table.columns[k] for k in columns]
+
+
+def json_record(rows: FromClause, keys: List[str], name: str) -> FromClause:
+    """The columns ``keys`` of ``rows``, to be sent as a JSON record.
+
+    Postgres writes numerics as JSON numbers, where the response models document
+    strings, as pydantic sends them: those are cast to text. Returns ``rows``
+    itself when it can be sent as is, otherwise a lateral select to join it to.
+    """
+    columns = [rows.c[k] for k in keys]
+    as_text = [python_type_from_column(c) is decimal.Decimal for c in columns]
+    if len(columns) == len(rows.c) and not any(as_text):
+        return rows
+    return (
+        select(
+            *[
+                cast(c, Text).label(c.key) if text_ else c
+                for c, text_ in zip(columns, as_text)
+            ]
+        )
+        .correlate(rows)
+        .lateral(name)
+    )
+
+
+def include_columns(include: List[RelationshipProperty]) -> List[ColumnElement]:
+    """JSON columns embedding the related records of each row.
+
+    Every relationship becomes a correlated subquery that Postgres evaluates
+    for the rows returned by the enclosing select, after its limit: the related
+    records are read in the same statement as their parents, with an index
+    lookup per row, instead of one request per relationship per row.
+    """
+    columns = []
+    for rel in include:
+        name = rel.key
+        target_table = rel.mapper.local_table
+        # aliased, a relationship may refer to its own table
+        target = target_table.alias(f"included_{name}")
+        if rel.secondary is None:
+            source = target
+            condition = and_(
+                *[
+                    target.c[remote.key] == local
+                    for local, remote in rel.local_remote_pairs
+                ]
+            )
+        else:
+            secondary = rel.secondary.alias(f"included_{name}_secondary")
+            source = target.join(
+                secondary,
+                and_(
+                    *[
+                        target.c[column.key] == secondary.c[key.key]
+                        for column, key in rel.secondary_synchronize_pairs
+                    ]
+                ),
+            )
+            condition = and_(
+                *[
+                    secondary.c[key.key] == column
+                    for column, key in rel.synchronize_pairs
+                ]
+            )
+        record = json_record(target, target.c.keys(), f"included_{name}_record")
+        if record is not target:
+            source = source.join(record, true())
+        if rel.uselist:
+            pks = [target.c[column.key] for column in target_table.primary_key]
+            value = func.coalesce(
+                func.json_agg(aggregate_order_by(record.table_valued(), *pks)),
+                text("'[]'::json"),
+                type_=JSON,
+            )
+        else:
+            value = func.row_to_json(record.table_valued(), type_=JSON)
+        related = select(value).select_from(source).where(condition)
+        columns.append(related.scalar_subquery().label(name))
+    return columns
+
+
+def list_statement(
+    table: Table,
+    filter_fields: List[str],
+    keys: List[Tuple[Column, bool]],
+    after: bool,
+    include: List[RelationshipProperty] = (),
+    where: Tuple | None = None,
+    columns: Tuple[str, ...] | None = None,
+) -> Select:
+    """Filtered and ordered select of the columns of a table.
+
+    Filter values are bound as ``filter_<column>`` and cursor values as
+    ``after_<n>``, so that the statement can be cached and reused. Related
+    records named in ``include`` are added as JSON columns, ``where`` is the
+    tree of a ``__filter`` expression and ``columns`` the ``__select`` ones.
+    """
+    statement = select(
+        *projection(table, columns), *include_columns(include)
+    ).order_by(
+        *[c.desc() if desc else c.asc() for c, desc in keys]
+    )
+    if after:
+        bounds = [
+            bindparam(f"after_{i}", type_=column.type)
+            for i, (column, _) in enumerate(keys)
+        ]
+        statement = statement.where(keyset_condition(keys, bounds))
+    if where is not None:
+        statement = statement.where(filters.condition(where, table))
+    for k in filter_fields:
+        column = table.columns[k]
+        # add the where condition to select expression
+        statement = statement.where(
+            column == bindparam(f"filter_{k}", type_=column.type)
+        )
+    return statement
+
+
+def sort_keys(table: Table, order_by: str | None) -> List[Tuple[Column, bool]]:
+    """Parse ``__order_by`` (``col1 desc,col2 asc``) into (column, descending) pairs.
+
+    Primary key columns are appended when missing, so that the ordering is total
+    and rows can be paginated by keyset.
+    """
+    keys = []
+    for term in filter(None, map(str.strip, (order_by or "").split(","))):
+        name, _, direction = term.partition(" ")
+        direction = direction.strip().lower() or "asc"
+        if name not in table.columns or direction not in ("asc", "desc"):
+            raise HTTPException(400, f"Invalid __order_by term '{term}'")
+        keys.append((table.columns[name], direction == "desc"))
+    for pk in table.primary_key.columns:
+        if all(pk is not key for key, _ in keys):
+            keys.append((pk, False))
+    return keys
+
+
+def encode_cursor(last_keys: str) -> str:
+    return base64.urlsafe_b64encode(last_keys.encode()).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, keys: List[Tuple[Column, bool]]) -> List[Any]:
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)),
+            # numerics are exact, floats would round them
+            parse_float=decimal.Decimal,
+        )
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        return [
+            # the last row of a page may have nulls in the nullable sort keys
+            None
+            if value is None and column.nullable
+            else TypeAdapter(python_type_from_column(column)).validate_python(value)
+            for (column, _), value in zip(keys, values)
+        ]
+    except (binascii.Error, ValueError, ValidationError):
+        # json and pydantic errors are ValueError subclasses too
+        raise HTTPException(400, "Invalid __after cursor")
+
+
+def keyset_condition(keys: List[Tuple[Column, bool]], values: List[Any]):
+    """Where condition selecting the rows that sort after ``values``.
+
+    Nulls sort after any value, as in the default Postgres ordering: last when
+    ascending, first when descending. Rows with nulls in a nullable sort key
+    are then paginated like the others, and a cursor may carry nulls.
+    """
+    if all(descending == keys[0][1] for _, descending in keys) and not any(
+        column.nullable for column, _ in keys
+    ):
+        # a row comparison can be answered by a single index range scan
+        columns = tuple_(*[column for column, _ in keys])
+        bounds = tuple_(*values)
+        return columns < bounds if keys[0][1] else columns > bounds
+    # mixed directions or nulls: (k1 > v1) or (k1 = v1 and k2 < v2) or ...
+    conditions = []
+    for i, (key, descending) in enumerate(keys):
+        conditions.append(
+            and_(
+                *[
+                    c.is_not_distinct_from(v) if c.nullable else c == v
+                    for (c, _), v in zip(keys[:i], values[:i])
+                ],
+                _sorts_after(key, descending, values[i]),
+            )
+        )
+    return or_(*conditions)
+
+
+def _sorts_after(column: Column, descending: bool, value: Any):
+    if not column.nullable:
+        return column < value if descending else column > value
+    if descending:
+        # nulls first: any value follows a null
+        return or_(column < value, and_(column.is_not(None), value.is_(None)))
+    # nulls last: a null follows any value
+    return or_(column > value, and_(column.is_(None), value.is_not(None)))
+
+
+def count_source(
+    table: Table, filter_fields: List[str], where: Tuple | None
+) -> Select:
+    """The rows of a list whatever the page and cursor, primary keys only."""
+    statement = list_statement(table, filter_fields, [], False, where=where)
+    return statement.with_only_columns(*table.primary_key.columns)
+
+
+def count_columns(
+    table: Table, filter_fields: List[str], where: Tuple | None, mode: str
+) -> List[ColumnElement]:
+    """Counts added to the page statement, computed in the same round trip.
+
+    ``exact`` counts every row. ``estimated`` stops counting past
+    ``count_exact_limit`` rows, so that large lists are not scanned in full,
+    and also reads the row estimate of the table statistics when the list is
+    not filtered. ``planned`` needs no column, it explains the list instead.
+    """
+    source = count_source(table, filter_fields, where)
+    if mode == "exact":
+        return [select(func.count()).select_from(source.subquery()).scalar_subquery()]
+    if mode != "estimated":
+        return []
+    capped = source.limit(settings.count_exact_limit + 1).subquery()
+    columns = [select(func.count()).select_from(capped).scalar_subquery()]
+    if not filter_fields and where is None:
+        # -1 when the table was never analyzed
+        reltuples = (
+            select(cast(column("reltuples"), BigInteger))
+            .select_from(text("pg_class"))
+            .where(
+                column("oid")
+                == func.to_regclass(
+                    func.format(
+                        "%I.%I", literal(table.schema, Text), literal(table.name, Text)
+                    )
+                )
+            )
+        )
+        columns.append(reltuples.scalar_subquery())
+    return columns
+
+
+async def total_count(
+    session: AsyncSession, mode: str, counts: Tuple, explain: Explain, params: dict
+) -> int:
+    """Total rows of a list from the counts of count_columns(), or its plan."""
+    if mode == "exact":
+        return counts[0]
+    if mode == "estimated":
+        if counts[0] <= settings.count_exact_limit:
+            return counts[0]
+        if len(counts) > 1 and counts[1] is not None and counts[1] >= 0:
+            return max(counts[1], counts[0])
+    plan = await session.scalar(explain, params)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]["Plan"]["Plan Rows"])
+    # past the limit, there are more rows than counted
+    return max(estimate, counts[0]) if counts else estimate
+
+
+def total_headers(total: int, offset: int | None, rows: int) -> Dict[str, str]:
+    """``X-Total-Count`` and ``Content-Range``, offset None after a cursor."""
+    if offset is None or rows == 0:
+        content_range = f"items */{total}"
+    else:
+        content_range = f"items {offset}-{offset + rows - 1}/{total}"
+    return {"X-Total-Count": str(total), "Content-Range": content_range}
+
+
+def json_array(
+    statement: Select,
+    cursor_keys: List[Tuple[Column, bool]] = (),
+    output: List[str] | None = None,
+) -> Select:
+    """Wrap a select so that Postgres aggregates its rows into one JSON array.
+
+    The array is returned as text and can be sent to the client as is, without
+    hydrating ORM objects or validating pydantic models row by row. When
+    ``cursor_keys`` are given, as (column, descending) pairs, rows are
+    aggregated in their order, and the row count and the keys of the last row
+    (as a JSON array) are returned as well. With ``output``, only the columns
+    it names are sent, the others are selected for the cursor.
+    """
+    rows = statement.subquery()
+    record = json_record(rows, rows.c.keys() if output is None else output, "selected")
+    value, source = record.table_valued(), rows
+    if record is not rows:
+        source = rows.join(record, true())
+    # the order of the subquery is not that of the aggregate without ORDER BY
+    order = [
+        rows.c[key.key].desc() if descending else rows.c[key.key].asc()
+        for key, descending in cursor_keys
+    ]
+    if order:
+        value = aggregate_order_by(value, *order)
+    columns = [cast(func.coalesce(func.json_agg(value), text("'[]'::json")), Text)]
+    if cursor_keys:
+        keys = func.json_build_array(*[rows.c[key.key] for key, _ in cursor_keys])
+        last_keys = func.json_agg(aggregate_order_by(keys, *order), type_=JSON)[-1]
+        columns += [func.count(), cast(last_keys, Text)]
+    return select(*columns).select_from(source)
+
+
+def json_object(statement: Select) -> Select:
+    """Wrap a select of at most one row so that Postgres returns it as JSON text."""
+    row = statement.subquery()
+    record = json_record(row, row.c.keys(), "selected")
+    source = row if record is row else row.join(record, true())
+    return select(cast(func.row_to_json(record.table_valued()), Text)).select_from(
+        source
+    )
+
+
+def json_array_by_keys(
+    table: Table,
+    include: List[RelationshipProperty],
+    columns: Tuple[str, ...] | None = None,
+) -> Select:
+    """The rows of a list of primary keys as a JSON array, in the order of the keys.
+
+    Keys are bound as one array per primary key column, ``keys_<n>``, and
+    joined to the table with unnest: a single statement whatever the number of
+    keys. Missing rows are null.
+    """
+    pks = list(table.primary_key.columns)
+    keys = (
+        func.unnest(
+            *[bindparam(f"keys_{i}", type_=ARRAY(pk.type)) for i, pk in enumerate(pks)]
+        )
+        .table_valued(*[pk.key for pk in pks], with_ordinality="position")
+        .render_derived(name="keys")
+    )
+    selected = select(
+        *projection(table, columns), *include_columns(include)
+    )
+    output = list(selected.selected_columns.keys())
+    # the keys are joined on, even when they are not selected
+    rows = selected.add_columns(*[pk for pk in pks if pk.key not in output]).subquery()
+    source = keys.outerjoin(
+        rows, and_(*[rows.c[pk.key] == keys.c[pk.key] for pk in pks])
+    )
+    row = json_record(rows, output, "selected")
+    if row is not rows:
+        source = source.outerjoin(row, true())
+    value = case(
+        (rows.c[pks[0].key].is_(None), null()),
+        else_=func.row_to_json(row.table_valued()),
+    )
+    return select(
+        cast(
+            func.coalesce(
+                func.json_agg(aggregate_order_by(value, keys.c.position)),
+                text("'[]'::json"),
+            ),
+            Text,
+        )
+    ).select_from(source)
 
 
 def create_endpoint(table_name: str, endpoint_type: str):
     endpoint = {}
     orm_class : DeclarativeMeta = Base.classes.get(table_name)
+    table: Table = orm_class.__table__
     if endpoint_type == "list":
         get_input = models_registry[table_name].get_input
         async def endpoint(
-            # request: Request,
+            request: Request,
             basic_filter: Annotated[get_input, Query(), Depends()], # type: ignore
             pagination: Annotated[PaginationParams, Query(), Depends()] = None,
             session: AsyncSession = Depends(get_async_session),
+            role: str = Depends(get_role),
+            include: Annotated[str | None, Query(alias="__include")] = None,
+            columns: Annotated[str | None, Query(alias="__select")] = None,
         ):
-            # TODO: role from jwt or anonymous
-            role = "fras.marco"
-            await session.execute(text(f"SET ROLE '{role}'"))
-            statement = (
-                select(orm_class).limit(pagination.limit).offset(pagination.offset)
-            )
-            for k in basic_filter.model_fields:
-                # skip attributes not in query string
-                if getattr(basic_filter, k):
-                    #print(getattr(basic_filter, k))
-                    # add the where condition to select expression
-                    statement = statement.where(getattr(orm_class, k) == getattr(basic_filter, k))
-            results = (await session.execute(statement)).scalars().all()
-            return results
+            keys = sort_keys(table, pagination.order_by)
+            include = parse_include(orm_class, include)
+            columns = parse_select(table, columns)
+            # skip attributes not in query string
+            filter_fields = [
+                k for k in basic_filter.model_fields
+                if getattr(basic_filter, k) is not None
+            ]
+            params = {f"filter_{k}": getattr(basic_filter, k) for k in filter_fields}
+            if pagination.after:
+                values = decode_cursor(pagination.after, keys)
+                params |= {f"after_{i}": value for i, value in enumerate(values)}
+            where = None
+            if pagination.filter:
+                where, values = filters.parse(pagination.filter)
+                params |= filters.parameters(where, values, table)
+            shape = (
+                tuple(filter_fields),
+                tuple((c.key, desc) for c, desc in keys),
+                bool(pagination.after),
+                tuple(rel.key for rel in include),
+                where,
+                columns,
+            )
+            # select plain columns, the response model is only used for the schema
+            statement = statement_cache.get(
+                table,
+                shape,
+                lambda: list_statement(
+                    table,
+                    filter_fields,
+                    keys,
+                    bool(pagination.after),
+                    include,
+                    where,
+                    columns,
+                ),
+            )
+            media_type = export.negotiate(request)
+            if media_type is not None:
+                # exports are not paginated: rows are streamed as they are read,
+                # on the primary, where replay conflicts cannot cancel them
+                return StreamingResponse(
+                    export.stream(
+                        role_connection(role), statement, params, media_type
+                    ),
+                    media_type=media_type,
+                )
+            key = cache.cache_key(request, role)
+            tables = included_tables(table, include)
+            if cache.enabled(tables):
+                entry = cache.response_cache.get(key, table_name)
+                if entry is not None:
+                    return cache.conditional_response(request, entry)
+            generation = cache.response_cache.generation(tables)
+
+            def build_page():
+                rows, output = statement, None
+                if columns is not None:
+                    output = list(statement.selected_columns.keys())
+                    # the cursor is made of the sort keys, selected or not
+                    rows = statement.add_columns(
+                        *[c for c, _ in keys if c.key not in output]
+                    )
+                page = json_array(
+                    rows.limit(bindparam("limit", type_=Integer)).offset(
+                        bindparam("offset", type_=Integer)
+                    ),
+                    keys,
+                    output,
+                )
+                if pagination.count is None:
+                    return page
+                return page.add_columns(
+                    *count_columns(table, filter_fields, where, pagination.count)
+                )
+
+            page = statement_cache.get(
+                table, (*shape, "page", pagination.count), build_page
+            )
+            params |= {"limit": pagination.limit, "offset": pagination.offset}
+
+            async def fetch():
+                await set_identity(await session.connection(), role)
+                start = time.perf_counter()
+                content, count, last_keys, *counts = (
+                    await session.execute(page, params)
+                ).one()
+                slowlog.slow_queries.observe(
+                    table_name, role, page, params, time.perf_counter() - start
+                )
+                total = None
+                if pagination.count is not None:
+                    explain = statement_cache.get(
+                        table,
+                        (*shape, "explain"),
+                        lambda: Explain(count_source(table, filter_fields, where)),
+                    )
+                    total = await total_count(
+                        session, pagination.count, counts, explain, params
+                    )
+                return content, count, last_keys, total
+
+            # identical concurrent requests share one query
+            content, count, last_keys, total = await cache.shared(
+                key, table_name, fetch
+            )
+            metrics.record_rows(count)
+            headers = {}
+            if count == pagination.limit:
+                next_url = request.url.remove_query_params("__offset")
+                next_url = next_url.include_query_params(
+                    __after=encode_cursor(last_keys)
+                )
+                headers["Link"] = f'<{next_url}>; rel="next"'
+            if total is not None:
+                offset = None if pagination.after else pagination.offset
+                headers |= total_headers(total, offset, count)
+            return cache.cached_response(
+                request, key, generation, content, headers, tables
+            )
+
+    if endpoint_type == "changes":
+        get_input = models_registry[table_name].get_input
+
+        async def endpoint(
+            basic_filter: Annotated[get_input, Query(), Depends()],  # type: ignore
+            role: str = Depends(get_role),
+        ):
+            if not settings.change_feeds:
+                raise HTTPException(404, "Change feeds are not enabled")
+            await feeds.authorize(table, role)
+            filters = {k: value for k, value in basic_filter if value is not None}
+            return StreamingResponse(
+                feeds.stream(table_name, filters),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache"},
+            )
 
     if endpoint_type == "get_one":
+        pks = list(table.primary_key.columns)
 
         async def endpoint(
             request: Request,
-            id: uuid.UUID,
             session: AsyncSession = Depends(get_async_session),
+            role: str = Depends(get_role),
+            include: Annotated[str | None, Query(alias="__include")] = None,
+            columns: Annotated[str | None, Query(alias="__select")] = None,
+            **keys,
         ):
-            role = "fras.marco"
-            await session.execute(text(f"SET ROLE '{role}'"))
-            return await session.get(orm_class, id)
+            include = parse_include(orm_class, include)
+            columns = parse_select(table, columns)
+            key = cache.cache_key(request, role)
+            tables = included_tables(table, include)
+            if cache.enabled(tables):
+                entry = cache.response_cache.get(key, table_name)
+                if entry is not None:
+                    return cache.conditional_response(request, entry)
+            generation = cache.response_cache.generation(tables)
+            # serialized by Postgres like the list, related records included
+            statement = statement_cache.get(
+                table,
+                ("one", tuple(rel.key for rel in include), columns),
+                lambda: json_object(
+                    select(
+                        *projection(table, columns),
+                        *include_columns(include),
+                    ).where(
+                        *[pk == bindparam(f"key_{pk.key}", type_=pk.type) for pk in pks]
+                    )
+                ),
+            )
+            params = {f"key_{k}": value for k, value in keys.items()}
+
+            async def fetch():
+                await set_identity(await session.connection(), role)
+                start = time.perf_counter()
+                content = await session.scalar(statement, params)
+                slowlog.slow_queries.observe(
+                    table_name, role, statement, params, time.perf_counter() - start
+                )
+                return content
+
+            content = await cache.shared(key, table_name, fetch)
+            metrics.record_rows(0 if content is None else 1)
+            if content is None:
+                raise HTTPException(404, f"{orm_class.__name__} not found")
+            return cache.cached_response(request, key, generation, content, {}, tables)
+
+        # a path parameter for each column of the primary key
+        signature = inspect_signature(endpoint)
+        endpoint.__signature__ = signature.replace(
+            parameters=[
+                *list(signature.parameters.values())[:-1],
+                *[
+                    Parameter(
+                        pk.key,
+                        Parameter.KEYWORD_ONLY,
+                        annotation=python_type_from_column(pk),
+                    )
+                    for pk in pks
+                ],
+            ]
+        )
+
+    if endpoint_type == "get_many":
+        key_type = primary_key_type(table)
+
+        async def endpoint(
+            keys: Annotated[
+                List[key_type],  # type: ignore
+                Body(max_length=settings.max_page_lenght),
+            ],
+            session: AsyncSession = Depends(get_async_session),
+            role: str = Depends(get_role),
+            include: Annotated[str | None, Query(alias="__include")] = None,
+            columns: Annotated[str | None, Query(alias="__select")] = None,
+        ):
+            include = parse_include(orm_class, include)
+            columns = parse_select(table, columns)
+            statement = statement_cache.get(
+                table,
+                ("many", tuple(rel.key for rel in include), columns),
+                lambda: json_array_by_keys(table, include, columns),
+            )
+            if not keys:
+                return Response(content="[]", media_type="application/json")
+            if len(table.primary_key.columns) == 1:
+                params = {"keys_0": keys}
+            else:
+                # one array per column
+                params = {
+                    f"keys_{i}": list(values) for i, values in enumerate(zip(*keys))
+                }
+            await set_identity(await session.connection(), role)
+            content = await session.scalar(statement, params)
+            metrics.record_rows(len(keys))
+            return Response(content=content, media_type="application/json")
+
+    if endpoint_type == "create":
+        create_input = models_registry[table_name].create_input
+
+        async def endpoint(request: Request, role: str = Depends(get_role)):
+            single, rows = await bulk.read_rows(request, create_input)
+            async with role_connection(role) as conn:
+                loader = bulk.BulkInsert(conn, table)
+                async for row in rows:
+                    await loader.add(row)
+                content = await loader.finish(single)
+                headers = await commit(conn)
+            # the change notification is asynchronous, read your own writes
+            cache.response_cache.invalidate(table_name)
+            return Response(
+                content=content,
+                media_type="application/json",
+                status_code=201,
+                headers=headers,
+            )
+
+    if endpoint_type in ("update", "replace"):
+        get_input = models_registry[table_name].get_input
+
+        async def endpoint(
+            request: Request,
+            basic_filter: Annotated[get_input, Query(), Depends()],  # type: ignore
+            filter: Annotated[str | None, Query(alias="__filter")] = None,
+            returning: Annotated[bool, Query(alias="__returning")] = False,
+            role: str = Depends(get_role),
+        ):
+            conditions, params = filter_conditions(table, basic_filter, filter)
+            single, rows = await bulk.read_rows(request, get_input)
+            rows = [row async for row in rows]
+            if single and not conditions:
+                raise HTTPException(400, "A filter is required to update rows")
+            async with role_connection(role) as conn:
+                change = bulk.BulkChange(conn, table, returning)
+                replace = endpoint_type == "replace"
+                if single:
+                    await change.update(conditions, params, rows[0], replace)
+                else:
+                    await change.update_keys(conditions, params, rows, replace)
+                headers = await commit(conn)
+            cache.response_cache.invalidate(table_name)
+            return Response(
+                content=change.response(),
+                media_type="application/json",
+                headers=headers,
+            )
+
+    if endpoint_type == "delete":
+        get_input = models_registry[table_name].get_input
+        pks = list(table.primary_key.columns)
+        key_type = primary_key_type(table)
+
+        async def endpoint(
+            request: Request,
+            basic_filter: Annotated[get_input, Query(), Depends()],  # type: ignore
+            filter: Annotated[str | None, Query(alias="__filter")] = None,
+            returning: Annotated[bool, Query(alias="__returning")] = False,
+            role: str = Depends(get_role),
+        ):
+            conditions, params = filter_conditions(table, basic_filter, filter)
+            body = await request.body()
+            keys = None
+            if body.strip():
+                try:
+                    keys = TypeAdapter(List[key_type]).validate_json(body)
+                except ValidationError as e:
+                    raise bulk.invalid(e)
+                if len(pks) == 1:
+                    keys = [(key,) for key in keys]
+            elif not conditions:
+                raise HTTPException(
+                    400, "A filter or a list of primary keys is required to delete"
+                )
+            async with role_connection(role) as conn:
+                change = bulk.BulkChange(conn, table, returning)
+                if keys is None:
+                    await change.delete(conditions, params)
+                else:
+                    await change.delete_keys(conditions, params, keys)
+                headers = await commit(conn)
+            cache.response_cache.invalidate(table_name)
+            return Response(
+                content=change.response(),
+                media_type="application/json",
+                headers=headers,
+            )
 
     return endpoint
 
 
-def add_routes(app: FastAPI):
-    introspect()
-    for key, item in models_registry.items():
-        table: Table = Base.classes.get(key).__table__
-        # list
+def primary_key_type(table: Table) -> type:
+    """Python type of a primary key value, a tuple for composite keys."""
+    types = [python_type_from_column(pk) for pk in table.primary_key.columns]
+    return types[0] if len(types) == 1 else Tuple[tuple(types)]
+
+
+def filter_conditions(
+    table: Table, basic_filter: BaseModel, filter: str | None
+) -> Tuple[List[ColumnElement], Dict[str, Any]]:
+    """Where conditions and bound values of the filters of the list route."""
+    conditions, params = [], {}
+    for k in basic_filter.model_fields:
+        if getattr(basic_filter, k) is not None:
+            column = table.columns[k]
+            conditions.append(column == bindparam(f"filter_{k}", type_=column.type))
+            params[f"filter_{k}"] = getattr(basic_filter, k)
+    if filter:
+        where, values = filters.parse(filter)
+        params |= filters.parameters(where, values, table)
+        conditions.append(filters.condition(where, table))
+    return conditions, params
+
+
+def create_body(item: RegistryItem) -> Dict[str, Any]:
+    """OpenAPI request body of the create route, read by the endpoint itself."""
+    schema = item.create_input.model_json_schema()
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"anyOf": [schema, {"type": "array", "items": schema}]}
+                },
+                "application/x-ndjson": {"schema": schema},
+            },
+        }
+    }
+
+
+def change_body(item: RegistryItem) -> Dict[str, Any]:
+    """OpenAPI request body of the update routes, read by the endpoint itself."""
+    schema = item.get_input.model_json_schema()
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"anyOf": [schema, {"type": "array", "items": schema}]}
+                },
+            },
+        }
+    }
+
+
+def table_routes(app: FastAPI, key: str, item: RegistryItem) -> List[BaseRoute]:
+    """Add the routes of a table to ``app`` and return them."""
+    start = len(app.router.routes)
+    table: Table = Base.classes.get(key).__table__
+    # list
+    app.add_api_route(
+        f"/api/{key.lower()}",
+        create_endpoint(key, "list"),
+        response_model=List[item.model],
+        responses=export.RESPONSES,
+        #dependencies=[Annotated[Depends(item.get_input), Query()]],
+        summary=f"List all {key}",
+        operation_id=f"get_all_{key}",
+        methods=["GET"],
+        tags=[key],
+    )
+    # change feed, before the get one route that would match its path
+    app.add_api_route(
+        f"/api/{key.lower()}/changes",
+        create_endpoint(key, "changes"),
+        summary=f"Stream the changes of {key}",
+        description=(
+            "Server-sent events named `insert`, `update` and `delete`, with "
+            "the changed row as data, or only its primary key under `keys` when "
+            "the table has row level security or the row is too large. The "
+            "filters apply to the new row, the old one for deletes. `reset` and "
+            "`overflow` tell that events were missed: read the table again."
+        ),
+        operation_id=f"changes_{key}",
+        methods=["GET"],
+        tags=[key],
+        response_class=StreamingResponse,
+        responses={200: {"content": {"text/event-stream": {}}}},
+    )
+    # get one by pk
+    pks = table.primary_key.columns.keys()
+    pk_path = "/".join([f"{{{pk}}}" for pk in pks])
+    app.add_api_route(
+        f"/api/{key.lower()}/{pk_path}",
+        create_endpoint(key, "get_one"),
+        response_model=item.model,
+        summary=f"Get one {inflect.singular_noun(key)} by primary key",
+        operation_id=f"get_one_{inflect.singular_noun(key)}",
+        methods=["GET"],
+        tags=[key],
+    )
+    # get many by pk, in the order of the keys
+    app.add_api_route(
+        f"/api/{key.lower()}/get",
+        create_endpoint(key, "get_many"),
+        response_model=List[item.model | None],
+        summary=f"Get many {key} by primary key",
+        description=(
+            "The body lists primary keys, arrays of values for composite keys. "
+            "Rows are returned in the same order, null when not found."
+        ),
+        operation_id=f"get_many_{key}",
+        methods=["POST"],
+        tags=[key],
+    )
+    # create one, or many from an array or NDJSON
+    app.add_api_route(
+        f"/api/{key.lower()}",
+        create_endpoint(key, "create"),
+        status_code=201,
+        response_model=item.model | List[item.model],
+        summary=f"Create {key}",
+        description=(
+            "Returns the created rows. Batches larger than "
+            f"{settings.bulk_copy_threshold} rows are loaded with COPY and only "
+            "their count is returned, as `{\"count\": n}`."
+        ),
+        operation_id=f"create_{key}",
+        methods=["POST"],
+        tags=[key],
+        openapi_extra=create_body(item),
+    )
+    # update or replace by filter, or by primary key with an array
+    changes_description = (
+        "A JSON object updates all the rows chosen by the filters. An array of "
+        "objects with their primary key updates each row with its own values. "
+        "Returns the number of changed rows, or the rows with `__returning=true`."
+    )
+    for method, endpoint_type, summary in [
+        ("PATCH", "update", "Update"),
+        ("PUT", "replace", "Replace"),
+    ]:
         app.add_api_route(
             f"/api/{key.lower()}",
-            create_endpoint(key, "list"),
-            response_model=List[item.model],
-            #dependencies=[Annotated[Depends(item.get_input), Query()]],
-            summary=f"List all {key}",
-            operation_id=f"get_all_{key}",
-            methods=["GET"],
-            tags=[key],
-        )
-        # get one by pk
-        # TODO: returning a single object, include related records
-        pks = table.primary_key.columns.keys()
-        "/".join([f"{{{pk}}}" for pk in pks])
-        app.add_api_route(
-            f"/api/{key.lower()}/{"/".join([f"{{{pk}}}" for pk in pks])}",
-            create_endpoint(key, "get_one"),
-            response_model=item.model,
-            summary=f"Get one {inflect.singular_noun(key)} by primary key",
-            operation_id=f"get_one_{inflect.singular_noun(key)}",
-            methods=["GET"],
+            create_endpoint(key, endpoint_type),
+            response_model=List[item.model] | ChangeCount,
+            summary=f"{summary} {key}",
+            description=changes_description,
+            operation_id=f"{endpoint_type}_{key}",
+            methods=[method],
             tags=[key],
+            openapi_extra=change_body(item),
         )
-        # The POST method is used for creating data
-        # The PUT replace completely the resource
-        # the PATCH method is used for partially updating a resource
-        # The DELETE method is used for removing data.
-        # http://api.example.com/v1/store/items/{id}✅
-        # http://api.example.com/v1/store/employees/{id}✅
-        # http://api.example.com/v1/store/employees/{id}/addresses
-        # /device-management/managed-devices/{id}/scripts/{id}/execute	//DON't DO THIS!
-        # /device-management/managed-devices/{id}/scripts/{id}/status		//POST request with action=execute
-        # $ protects keywords in pagination and advanced filtering
-        # /api/books?$offset=0&$limit=10&$orderBy=author desc,title asc
-        # basic FILTER on equality of fields
-        # http://api.example.com/v1/store/items?group=124
-        # http://api.example.com/v1/store/employees?department=IT&region=USA
-        # advanced FILTER on multiple fields using expressions
-        # /api/books?page=0&size=20&$filter=author eq 'Fitzgerald'
-        # /api/books?page=0&size=20&$filter=(author eq 'Fitzgerald' or name eq 'Redmond') and price lt 2.55
-        # /v1.0/people?$filter=name eq 'david'&$orderBy=hireDate
-        # https://docs.oasis-open.org/odata/odata/v4.01/odata-v4.01-part2-url-conventions.html#_Toc31361038
+    keys = TypeAdapter(List[primary_key_type(table)]).json_schema()
+    app.add_api_route(
+        f"/api/{key.lower()}",
+        create_endpoint(key, "delete"),
+        response_model=List[item.model] | ChangeCount,
+        summary=f"Delete {key}",
+        description=(
+            "Deletes the rows chosen by the filters, or by the primary keys listed "
+            "in the body. Returns the number of deleted rows, or the rows with "
+            "`__returning=true`."
+        ),
+        operation_id=f"delete_{key}",
+        methods=["DELETE"],
+        tags=[key],
+        openapi_extra={
+            "requestBody": {"content": {"application/json": {"schema": keys}}}
+        },
+    )
+    # The POST method is used for creating data
+    # The PUT replace completely the resource
+    # the PATCH method is used for partially updating a resource
+    # The DELETE method is used for removing data.
+    # http://api.example.com/v1/store/items/{id}✅
+    # http://api.example.com/v1/store/employees/{id}✅
+    # http://api.example.com/v1/store/employees/{id}/addresses
+    # /device-management/managed-devices/{id}/scripts/{id}/execute	//DON't DO THIS!
+    # /device-management/managed-devices/{id}/scripts/{id}/status		//POST request with action=execute
+    # $ protects keywords in pagination and advanced filtering
+    # /api/books?$offset=0&$limit=10&$orderBy=author desc,title asc
+    # basic FILTER on equality of fields
+    # http://api.example.com/v1/store/items?group=124
+    # http://api.example.com/v1/store/employees?department=IT&region=USA
+    # advanced FILTER on multiple fields using expressions
+    # /api/books?page=0&size=20&$filter=author eq 'Fitzgerald'
+    # /api/books?page=0&size=20&$filter=(author eq 'Fitzgerald' or name eq 'Redmond') and price lt 2.55
+    # /v1.0/people?$filter=name eq 'david'&$orderBy=hireDate
+    # https://docs.oasis-open.org/odata/odata/v4.01/odata-v4.01-part2-url-conventions.html#_Toc31361038
+    return app.router.routes[start:]
+
+
+async def add_routes(app: FastAPI):
+    await introspect()
+    for key, item in models_registry.items():
+        routes_registry[key] = table_routes(app, key, item)
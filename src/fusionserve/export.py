@@ -0,0 +1,191 @@
+import csv
+import datetime
+import decimal
+import io
+from typing import AsyncContextManager, AsyncIterator, Dict, List, Type
+
+from fastapi import Request
+from sqlalchemy import Column, Row, Select, Text, cast, func, select
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import metrics
+from .config import settings
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    # Arrow and Parquet exports need the `arrow` extra
+    pa = None
+
+
+class NdjsonExport:
+    """One JSON document per row, serialized by Postgres."""
+
+    def __init__(self, statement: Select):
+        rows = statement.subquery()
+        self.statement = select(cast(func.row_to_json(rows.table_valued()), Text))
+
+    def header(self) -> str:
+        return ""
+
+    def batch(self, rows: List[Row]) -> str:
+        return "".join(f"{row[0]}\n" for row in rows)
+
+    def footer(self) -> str:
+        return ""
+
+
+class CsvExport:
+    """Values in the Postgres text format, as COPY ... CSV would write them."""
+
+    def __init__(self, statement: Select):
+        rows = statement.subquery()
+        self.columns = [column.name for column in rows.c]
+        self.statement = select(
+            *[cast(column, Text).label(column.name) for column in rows.c]
+        )
+
+    def _write(self, rows) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+
+    def header(self) -> str:
+        return self._write([self.columns])
+
+    def batch(self, rows: List[Row]) -> str:
+        return self._write(rows)
+
+    def footer(self) -> str:
+        return ""
+
+
+def arrow_type(column: Column) -> "pa.DataType | None":
+    """Arrow type of a column, None when values are better sent as text."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is datetime.datetime:
+        return pa.timestamp("us", tz="UTC" if column.type.timezone else None)
+    if python_type is decimal.Decimal:
+        precision = getattr(column.type, "precision", None)
+        if precision is None or precision > 38:
+            return None
+        return pa.decimal128(precision, column.type.scale or 0)
+    return {
+        bool: pa.bool_(),
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        bytes: pa.binary(),
+        datetime.date: pa.date32(),
+        datetime.time: pa.time64("us"),
+        datetime.timedelta: pa.duration("us"),
+    }.get(python_type)
+
+
+class ArrowExport:
+    """Record batches in the Arrow IPC streaming format.
+
+    The schema follows the reflected column types. Columns without a native
+    Arrow type (uuid, json, arrays, ...) are cast to text by Postgres.
+    """
+
+    def __init__(self, statement: Select):
+        rows = statement.subquery()
+        columns, fields = [], []
+        for column in rows.c:
+            type_ = arrow_type(column)
+            if type_ is None:
+                type_ = pa.string()
+                column = cast(column, Text).label(column.name)
+            columns.append(column)
+            fields.append(pa.field(column.name, type_))
+        self.statement = select(*columns)
+        self.schema = pa.schema(fields)
+        self.buffer = io.BytesIO()
+        self.writer = self._writer()
+
+    def _writer(self):
+        return pa.ipc.new_stream(self.buffer, self.schema)
+
+    def _flush(self) -> bytes:
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def header(self) -> bytes:
+        return self._flush()
+
+    def batch(self, rows: List[Row]) -> bytes:
+        self.writer.write_batch(
+            pa.RecordBatch.from_arrays(
+                [
+                    pa.array(values, type=field.type)
+                    for values, field in zip(zip(*rows), self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        return self._flush()
+
+    def footer(self) -> bytes:
+        self.writer.close()
+        return self._flush()
+
+
+class ParquetExport(ArrowExport):
+    """A Parquet file with one row group per batch."""
+
+    def _writer(self):
+        return pq.ParquetWriter(self.buffer, self.schema)
+
+
+FORMATS: Dict[str, Type] = {
+    "application/x-ndjson": NdjsonExport,
+    "text/csv": CsvExport,
+}
+if pa is not None:
+    FORMATS["application/vnd.apache.arrow.stream"] = ArrowExport
+    FORMATS["application/vnd.apache.parquet"] = ParquetExport
+
+# documents the export formats in the OpenAPI schema of the list routes
+RESPONSES = {200: {"content": {media_type: {} for media_type in FORMATS}}}
+
+
+def negotiate(request: Request) -> str | None:
+    """The export format requested by the Accept header, None for plain JSON."""
+    accept = request.headers.get("accept", "")
+    for media_type in FORMATS:
+        if media_type in accept:
+            return media_type
+    return None
+
+
+async def stream(
+    connection: AsyncContextManager[AsyncConnection],
+    statement: Select,
+    params: dict,
+    media_type: str,
+) -> AsyncIterator[str | bytes]:
+    """Stream the rows of ``statement`` through a server side cursor.
+
+    Rows are fetched and encoded ``export_batch_size`` at a time, so memory use
+    does not depend on the size of the result. The connection is acquired when
+    the response starts streaming and released when it ends or the client
+    disconnects.
+    """
+    export = FORMATS[media_type](statement)
+    yield export.header()
+    async with connection as conn:
+        result = await conn.stream(
+            export.statement.execution_options(yield_per=settings.export_batch_size),
+            params,
+        )
+        async for rows in result.partitions():
+            metrics.record_rows(len(rows))
+            yield export.batch(rows)
+    yield export.footer()
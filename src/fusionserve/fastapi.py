@@ -9,8 +9,12 @@ from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import PlainTextResponse
 from prometheus_client import REGISTRY, generate_latest
 
+from . import batch, cache, feeds, gql, reload, replicas, slowlog
 from .config import settings
-from .db import add_routes
+from .db import add_routes, engine
+from .metrics import MetricsMiddleware
+from .notify import listener
+from .profiling import ProfileMiddleware
 
 _logger = logging.getLogger("uvicorn.error")
 _logger.setLevel(os.environ.get("LOG_LEVEL", "ERROR"))
@@ -19,8 +23,23 @@ _logger.setLevel(os.environ.get("LOG_LEVEL", "ERROR"))
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # ---- startup ----
-    add_routes(app)
+    await add_routes(app)
+    gql.add_route(app)
+    batch.add_route(app)
+    slowlog.add_route(app)
+    await replicas.replica_set.start()
+    if settings.response_cache:
+        await cache.start()
+    if settings.change_feeds:
+        await feeds.start()
+    if settings.schema_reload:
+        await reload.start(app)
     yield
+    # ---- shutdown ----
+    await reload.stop()
+    await replicas.replica_set.stop()
+    await listener.stop()
+    await engine.dispose()
 
 
 # uvicorn entry point
@@ -32,7 +51,11 @@ app = FastAPI(
     redirect_slashes=False,
     lifespan=lifespan,
 )
+# inside the compression, to measure the serialized size of the responses
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
+# outermost, to profile the whole request
+app.add_middleware(ProfileMiddleware)
 
 
 @app.get("/metrics")
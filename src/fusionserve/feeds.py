@@ -0,0 +1,247 @@
+import asyncio
+import json
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Set
+
+from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import Table, text
+from sqlalchemy.exc import DBAPIError
+
+from . import db, metrics
+from .config import logger as _logger
+from .config import settings
+from .notify import listener
+
+ROW_CHANNEL = "fusionserve_row"
+
+# Sends each changed row, or only its primary key when the row is too large
+# for a notification or when row level security may hide it from subscribers.
+# The trigger arguments are the names of the primary key columns.
+NOTIFY_ROW_FUNCTION = text(
+    f"""
+    CREATE OR REPLACE FUNCTION public.fusionserve_notify_row()
+    RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        rec record;
+        payload text;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            rec := OLD;
+        ELSE
+            rec := NEW;
+        END IF;
+        IF NOT (SELECT relrowsecurity FROM pg_class WHERE oid = TG_RELID) THEN
+            payload := json_build_object(
+                'table', TG_TABLE_NAME, 'op', lower(TG_OP), 'row', row_to_json(rec)
+            )::text;
+        END IF;
+        IF payload IS NULL OR octet_length(payload) > 7900 THEN
+            payload := json_build_object(
+                'table', TG_TABLE_NAME, 'op', lower(TG_OP), 'keys', (
+                    SELECT json_object_agg(k, row_to_json(rec) -> k)
+                    FROM unnest(TG_ARGV) AS k
+                )
+            )::text;
+        END IF;
+        PERFORM pg_notify('{ROW_CHANNEL}', payload);
+        RETURN NULL;
+    END $$
+    """
+)
+
+WATCHED_TABLES = text(
+    """
+    SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_trigger t ON t.tgrelid = c.oid
+    WHERE n.nspname = :schema AND t.tgname = 'fusionserve_row_change'
+    """
+)
+
+CAN_SELECT = text(
+    "SELECT has_table_privilege("
+    "format('%I.%I', CAST(:schema AS text), CAST(:table AS text)), 'SELECT')"
+)
+
+
+@lru_cache(maxsize=None)
+def _adapter(python_type: type) -> TypeAdapter:
+    return TypeAdapter(python_type)
+
+
+class Subscriber:
+    """A change feed client, with a bounded queue of events to send."""
+
+    def __init__(self, table_name: str, filters: Dict[str, Any]):
+        self.table_name = table_name
+        self.filters = filters
+        self.queue: asyncio.Queue[str] = asyncio.Queue(settings.change_feed_queue_size)
+        self.overflowed = False
+
+    def send(self, message: str):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # dropped rather than buffered without limit, the client reads
+            # the table again after the overflow event
+            self.overflowed = True
+            metrics.change_feed_overflows.labels(self.table_name).inc()
+
+
+class ChangeFeeds:
+    """Row changes fanned out to the subscribers of each table.
+
+    A notification is parsed and formatted once, whatever the number of
+    subscribers. Filters compare the changed row, the new one except for
+    deletes, with the basic filters of each subscription; the row values are
+    converted to the column types once per event. Columns missing from an
+    event sent with the primary key only cannot be compared, such events go to
+    every subscriber of the table. Only the ``watched`` tables, those with a
+    row trigger, have a feed.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[Subscriber]] = defaultdict(set)
+        self.watched: Set[str] = set()
+
+    def subscribe(self, table_name: str, filters: Dict[str, Any]) -> Subscriber:
+        subscriber = Subscriber(table_name, filters)
+        self.subscribers[table_name].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self.subscribers.get(subscriber.table_name)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[subscriber.table_name]
+
+    def count(self) -> int:
+        return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+    def dispatch(self, payload: str):
+        event = json.loads(payload)
+        subscribers = self.subscribers.get(event["table"])
+        if not subscribers:
+            return
+        table: Table = db.Base.classes.get(event["table"]).__table__
+        row = event.get("row") or event.get("keys") or {}
+        message = f"event: {event['op']}\ndata: {payload}\n\n"
+        typed: Dict[str, Any] = {}
+
+        def matches(k: str, value: Any) -> bool:
+            if k not in row:
+                return True
+            if k not in typed:
+                python_type = db.python_type_from_column(table.columns[k])
+                try:
+                    typed[k] = _adapter(python_type).validate_python(row[k])
+                except ValidationError:
+                    typed[k] = None
+            return typed[k] == value
+
+        for subscriber in list(subscribers):
+            if all(matches(k, value) for k, value in subscriber.filters.items()):
+                subscriber.send(message)
+
+    def reset(self):
+        """Tell every subscriber that changes may have been missed."""
+        for subscribers in self.subscribers.values():
+            for subscriber in list(subscribers):
+                subscriber.send("event: reset\ndata: {}\n\n")
+
+
+change_feeds = ChangeFeeds()
+metrics.change_feed_subscribers.set_function(change_feeds.count)
+
+
+async def authorize(table: Table, role: str):
+    """403 unless ``role`` may read ``table``, events bypass the SELECT checks.
+
+    503 when the changes of ``table`` are not notified, rather than a feed that
+    stays silent.
+    """
+    if table.name not in change_feeds.watched:
+        raise HTTPException(503, f"No change feed for table {table.name}")
+    async with db.role_connection(role) as conn:
+        allowed = await conn.scalar(
+            CAN_SELECT, {"schema": table.schema, "table": table.name}
+        )
+    if not allowed:
+        raise HTTPException(403, f"Permission denied for table {table.name}")
+
+
+async def stream(table_name: str, filters: Dict[str, Any]) -> AsyncIterator[str]:
+    """Server-sent events of the changes of a table, until the client leaves."""
+    subscriber = change_feeds.subscribe(table_name, filters)
+    try:
+        # sent at once, so that the client knows it is subscribed
+        yield ": subscribed\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    subscriber.queue.get(), settings.change_feed_keepalive
+                )
+            except asyncio.TimeoutError:
+                # proxies close idle connections, and a write finds dead clients
+                yield ": keepalive\n\n"
+                continue
+            if subscriber.overflowed:
+                yield "event: overflow\ndata: {}\n\n"
+                return
+            yield message
+    finally:
+        change_feeds.unsubscribe(subscriber)
+
+
+async def install_row_triggers():
+    """Add a row trigger notifying the changed rows to every table with routes.
+
+    The tables with a trigger, installed now or by their owner, are watched.
+    """
+    schema = {"schema": settings.pg_app_schema}
+    try:
+        async with db.role_connection(None) as conn:
+            await conn.execute(NOTIFY_ROW_FUNCTION)
+            watched = set((await conn.scalars(WATCHED_TABLES, schema)).all())
+            quote = conn.dialect.identifier_preparer.quote
+            for name in db.models_registry:
+                if name in watched:
+                    continue
+                table: Table = db.Base.classes.get(name).__table__
+                keys = ", ".join(
+                    "'" + k.replace("'", "''") + "'"
+                    for k in table.primary_key.columns.keys()
+                )
+                try:
+                    # one table we do not own must not fail the others
+                    async with conn.begin_nested():
+                        await conn.execute(
+                            text(
+                                "CREATE TRIGGER fusionserve_row_change "
+                                "AFTER INSERT OR UPDATE OR DELETE "
+                                f"ON {quote(table.schema)}.{quote(table.name)} "
+                                "FOR EACH ROW EXECUTE FUNCTION "
+                                f"public.fusionserve_notify_row({keys})"
+                            )
+                        )
+                except DBAPIError as e:
+                    _logger.warning(f"No change feed for table {name}: {e}")
+            await conn.commit()
+    except DBAPIError as e:
+        _logger.warning(f"Unable to install the row change triggers: {e}")
+    async with db.role_connection(None) as conn:
+        change_feeds.watched = set((await conn.scalars(WATCHED_TABLES, schema)).all())
+
+
+async def start():
+    """Feed the changes notified by the row triggers to the subscribers."""
+    await install_row_triggers()
+    await listener.listen(ROW_CHANNEL, change_feeds.dispatch)
+    # notifications are lost while the listener reconnects
+    listener.on_reconnect.append(change_feeds.reset)
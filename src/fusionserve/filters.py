@@ -0,0 +1,281 @@
+import re
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+
+from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import ColumnElement, Table, and_, bindparam, not_, or_
+
+from . import db
+
+# A subset of the OData $filter grammar:
+#
+#   expression := term ("or" term)*
+#   term       := factor ("and" factor)*
+#   factor     := "not" factor | "(" expression ")" | predicate
+#   predicate  := column ("eq" | "ne" | "gt" | "ge" | "lt" | "le") literal
+#               | column "in" "(" literal ("," literal)* ")"
+#               | ("contains" | "startswith" | "endswith") "(" column "," string ")"
+#   literal    := 'text with '' quotes' | number | true | false | null
+#
+# e.g. (author eq 'Fitzgerald' or name eq 'Redmond') and price lt 2.55
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<string>'(?:[^']|'')*')
+        |(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<punctuation>[(),])
+    )""",
+    re.VERBOSE,
+)
+
+COMPARISONS = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "gt": lambda column, value: column > value,
+    "ge": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "le": lambda column, value: column <= value,
+}
+
+FUNCTIONS = {
+    "contains": lambda column, value: column.contains(value, escape="/"),
+    "startswith": lambda column, value: column.startswith(value, escape="/"),
+    "endswith": lambda column, value: column.endswith(value, escape="/"),
+}
+
+NULL = object()
+
+# bounds of an expression, parsed and compiled recursively
+MAX_LENGTH = 4096
+MAX_DEPTH = 32
+
+
+def _error(message: str) -> HTTPException:
+    return HTTPException(400, f"Invalid __filter: {message}")
+
+
+def tokenize(expression: str) -> List[Tuple[str, Any]]:
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise _error(f"unexpected character at {position}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace("''", "'")
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser building the tree of a filter expression.
+
+    The tree holds the positions of the literals instead of their values, so
+    that expressions differing only by values share the same tree, and the
+    same cached statement.
+    """
+
+    def __init__(self, expression: str):
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.values: List[Any] = []
+        self.depth = 0
+
+    def peek(self, offset: int = 0) -> Tuple[str, Any] | None:
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None
+
+    def next(self) -> Tuple[str, Any]:
+        token = self.peek()
+        if token is None:
+            raise _error("unexpected end")
+        self.position += 1
+        return token
+
+    def expect(self, value: str):
+        kind, found = self.next()
+        if found != value or kind == "string":
+            raise _error(f"expected '{value}', found '{found}'")
+
+    def accept(self, value: str) -> bool:
+        token = self.peek()
+        if token is not None and token[0] != "string" and token[1] == value:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self) -> Tuple:
+        tree = self.expression()
+        if self.peek() is not None:
+            raise _error(f"unexpected '{self.peek()[1]}'")
+        return tree
+
+    def expression(self) -> Tuple:
+        terms = [self.term()]
+        while self.accept("or"):
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else ("or", *terms)
+
+    def term(self) -> Tuple:
+        factors = [self.factor()]
+        while self.accept("and"):
+            factors.append(self.factor())
+        return factors[0] if len(factors) == 1 else ("and", *factors)
+
+    def factor(self) -> Tuple:
+        if self.accept("not"):
+            with self.nested():
+                return ("not", self.factor())
+        if self.accept("("):
+            with self.nested():
+                tree = self.expression()
+            self.expect(")")
+            return tree
+        return self.predicate()
+
+    @contextmanager
+    def nested(self):
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise _error(f"nested more than {MAX_DEPTH} levels")
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+    def column(self) -> str:
+        kind, name = self.next()
+        if kind != "name":
+            raise _error(f"expected a column, found '{name}'")
+        return name
+
+    def literal(self) -> int:
+        kind, value = self.next()
+        if kind == "name":
+            try:
+                value = {"true": True, "false": False, "null": NULL}[value]
+            except KeyError:
+                raise _error(f"expected a value, found '{value}'")
+        elif kind == "punctuation":
+            raise _error(f"expected a value, found '{value}'")
+        self.values.append(value)
+        return len(self.values) - 1
+
+    def predicate(self) -> Tuple:
+        token = self.peek(1)
+        if token == ("punctuation", "(") and self.peek()[1] in FUNCTIONS:
+            function = self.next()[1]
+            self.expect("(")
+            column = self.column()
+            self.expect(",")
+            if (self.peek() or (None,))[0] != "string":
+                raise _error(f"{function} needs a quoted string")
+            index = self.literal()
+            self.expect(")")
+            return ("function", function, column, index)
+        column = self.column()
+        kind, operator = self.next()
+        if operator == "in" and kind == "name":
+            self.expect("(")
+            indexes = [self.literal()]
+            while self.accept(","):
+                indexes.append(self.literal())
+            self.expect(")")
+            if any(self.values[i] is NULL for i in indexes):
+                raise _error("null in a list")
+            # the list is bound as a single expanding parameter
+            values = [self.values[i] for i in indexes]
+            self.values[indexes[0] :] = [values]
+            return ("in", column, indexes[0])
+        if operator not in COMPARISONS or kind != "name":
+            raise _error(f"unknown operator '{operator}'")
+        index = self.literal()
+        if self.values[index] is NULL:
+            if operator not in ("eq", "ne"):
+                raise _error(f"null with {operator}")
+            return ("null", operator, column)
+        return ("compare", operator, column, index)
+
+
+@lru_cache(maxsize=1024)
+def parse(expression: str) -> Tuple[Tuple, Tuple]:
+    """Tree and literal values of a ``__filter`` expression."""
+    if len(expression) > MAX_LENGTH:
+        raise _error(f"longer than {MAX_LENGTH} characters")
+    parser = Parser(expression)
+    tree = parser.parse()
+    return tree, tuple(parser.values)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def parameters(tree: Tuple, values: Tuple, table: Table) -> Dict[str, Any]:
+    """Bound values of a filter, converted to the types of the columns.
+
+    Also validates the column names, so that condition() can trust them.
+    """
+    params = {}
+    for node in _nodes(tree):
+        kind = node[0]
+        if kind in ("and", "or", "not"):
+            continue
+        name = node[2] if kind in ("compare", "null", "function") else node[1]
+        if name not in table.columns:
+            raise _error(f"unknown column '{name}'")
+        if kind == "null":
+            continue
+        column = table.columns[name]
+        index = node[-1]
+        python_type = db.python_type_from_column(column)
+        if kind == "function":
+            if python_type is not str:
+                raise _error(f"{node[1]} on the non text column '{name}'")
+            params[f"where_{index}"] = _escape_like(values[index])
+            continue
+        adapter = TypeAdapter(List[python_type] if kind == "in" else python_type)
+        try:
+            params[f"where_{index}"] = adapter.validate_python(values[index])
+        except ValidationError:
+            raise _error(f"invalid value for column '{name}'")
+    return params
+
+
+def condition(tree: Tuple, table: Table) -> ColumnElement[bool]:
+    """Where condition of a filter tree, values bound as ``where_<n>``."""
+    kind = tree[0]
+    if kind == "or":
+        return or_(*[condition(node, table) for node in tree[1:]])
+    if kind == "and":
+        return and_(*[condition(node, table) for node in tree[1:]])
+    if kind == "not":
+        return not_(condition(tree[1], table))
+    if kind == "null":
+        column = table.columns[tree[2]]
+        return column.is_(None) if tree[1] == "eq" else column.is_not(None)
+    if kind == "in":
+        column = table.columns[tree[1]]
+        return column.in_(
+            bindparam(f"where_{tree[2]}", type_=column.type, expanding=True)
+        )
+    column = table.columns[tree[2]]
+    value = bindparam(f"where_{tree[3]}", type_=column.type)
+    if kind == "function":
+        return FUNCTIONS[tree[1]](column, value)
+    return COMPARISONS[tree[1]](column, value)
+
+
+def _nodes(tree: Tuple):
+    yield tree
+    if tree[0] in ("and", "or", "not"):
+        for node in tree[1:]:
+            yield from _nodes(node)
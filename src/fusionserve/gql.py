@@ -0,0 +1,461 @@
+import asyncio
+import datetime
+import decimal
+import uuid
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from fastapi import Body, Depends, FastAPI
+from fastapi.responses import JSONResponse
+from graphql import (
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLArgument,
+    GraphQLBoolean,
+    GraphQLError,
+    GraphQLField,
+    GraphQLFloat,
+    GraphQLInt,
+    GraphQLList,
+    GraphQLNonNull,
+    GraphQLObjectType,
+    GraphQLScalarType,
+    GraphQLSchema,
+    GraphQLString,
+    OperationDefinitionNode,
+    SelectionSetNode,
+    execute,
+    get_named_type,
+    get_nullable_type,
+    parse,
+    validate,
+    value_from_ast_untyped,
+)
+from pydantic.alias_generators import to_camel, to_pascal
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    Table,
+    func,
+    inspect,
+    select,
+    tuple_,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import RelationshipDirection
+
+from . import db, metrics
+from .config import settings
+
+UUIDScalar = GraphQLScalarType("UUID", serialize=str, parse_value=uuid.UUID)
+DatetimeScalar = GraphQLScalarType(
+    "Datetime",
+    serialize=lambda v: v.isoformat(),
+    parse_value=datetime.datetime.fromisoformat,
+)
+DateScalar = GraphQLScalarType(
+    "Date", serialize=lambda v: v.isoformat(), parse_value=datetime.date.fromisoformat
+)
+TimeScalar = GraphQLScalarType(
+    "Time", serialize=lambda v: v.isoformat(), parse_value=datetime.time.fromisoformat
+)
+DecimalScalar = GraphQLScalarType(
+    "Decimal", serialize=str, parse_value=lambda v: decimal.Decimal(str(v))
+)
+BigIntScalar = GraphQLScalarType("BigInt", serialize=int, parse_value=int)
+JSONScalar = GraphQLScalarType("JSON", serialize=lambda v: v)
+# any other type, sent as text
+TextScalar = GraphQLScalarType("Text", serialize=str)
+
+SCALARS = {
+    bool: GraphQLBoolean,
+    int: GraphQLInt,
+    float: GraphQLFloat,
+    str: GraphQLString,
+    uuid.UUID: UUIDScalar,
+    datetime.datetime: DatetimeScalar,
+    datetime.date: DateScalar,
+    datetime.time: TimeScalar,
+    decimal.Decimal: DecimalScalar,
+}
+
+# names an object type of a table must not take
+RESERVED_NAMES = {
+    "Query",
+    "ID",
+    *[scalar.name for scalar in SCALARS.values()],
+    *[scalar.name for scalar in (BigIntScalar, JSONScalar, TextScalar)],
+}
+
+schema: GraphQLSchema = None
+
+
+def scalar_from_column(column: Column) -> GraphQLScalarType:
+    if isinstance(column.type, BigInteger):
+        # GraphQL Int is 32 bit
+        return BigIntScalar
+    if isinstance(column.type, JSON):
+        return JSONScalar
+    return SCALARS.get(db.python_type_from_column(column), TextScalar)
+
+
+def type_name(singular: str, taken: Set[str]) -> str:
+    """Name of the object type of a table, ``Type`` appended on a clash.
+
+    A ``times`` table would otherwise be named like the ``Time`` scalar, and
+    ``job_types`` and ``Job_types`` like each other.
+    """
+    name = to_pascal(singular)
+    if name in taken:
+        name += "Type"
+    unique, n = name, 2
+    while unique in taken:
+        unique, n = f"{name}{n}", n + 1
+    taken.add(unique)
+    return unique
+
+
+class Loader:
+    """Load the rows requested by many resolvers of the same tick in one query.
+
+    Keys are tuples of values of ``columns``, ``load`` returns a future of the
+    list of rows of ``table`` matching the key, at most ``limit`` of them.
+    Results are cached for the lifetime of the loader, that is a single request.
+    """
+
+    def __init__(
+        self,
+        context: "Context",
+        table: Table,
+        columns: List[Column],
+        limit: int | None = None,
+    ):
+        self.context = context
+        self.table = table
+        self.columns = columns
+        self.limit = limit
+        self.futures: Dict[Tuple, asyncio.Future] = {}
+        self.queue: List[Tuple] = []
+
+    def load(self, key: Tuple) -> asyncio.Future:
+        if key not in self.futures:
+            loop = asyncio.get_running_loop()
+            self.futures[key] = loop.create_future()
+            self.queue.append(key)
+            if len(self.queue) == 1:
+                # resolvers of sibling objects run before the next tick
+                loop.call_soon(lambda: asyncio.ensure_future(self.dispatch()))
+        return self.futures[key]
+
+    async def dispatch(self):
+        keys, self.queue = self.queue, []
+        if len(self.columns) == 1:
+            condition = self.columns[0].in_([key[0] for key in keys])
+        else:
+            condition = tuple_(*self.columns).in_(keys)
+        statement = select(*self.table.columns).where(condition)
+        if self.limit is not None:
+            # the first rows of each key, in a single query
+            ranked = statement.add_columns(
+                func.row_number()
+                .over(
+                    partition_by=self.columns,
+                    order_by=list(self.table.primary_key.columns),
+                )
+                .label("fusionserve_rank")
+            ).subquery()
+            statement = select(
+                *[ranked.c[column.key] for column in self.table.columns]
+            ).where(ranked.c.fusionserve_rank <= self.limit)
+            order_by = [ranked.c[column.key] for column in self.table.primary_key]
+        else:
+            order_by = list(self.table.primary_key.columns)
+        statement = statement.order_by(*order_by)
+        try:
+            rows = await self.context.fetch(statement)
+        except Exception as e:
+            for key in keys:
+                self.futures[key].set_exception(e)
+            return
+        grouped: Dict[Tuple, List] = {key: [] for key in keys}
+        for row in rows:
+            grouped[tuple(row[column.key] for column in self.columns)].append(row)
+        for key, matches in grouped.items():
+            self.futures[key].set_result(matches)
+
+
+class Context:
+    """Per request state shared by the resolvers."""
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        # a session runs one statement at a time, loaders may dispatch together
+        self.lock = asyncio.Lock()
+        self.loaders: Dict[Tuple, Loader] = {}
+
+    async def fetch(self, statement) -> List[Dict[str, Any]]:
+        async with self.lock:
+            rows = (await self.session.execute(statement)).mappings().all()
+        metrics.record_rows(len(rows))
+        return rows
+
+    def loader(
+        self, table: Table, columns: List[Column], limit: int | None = None
+    ) -> Loader:
+        key = (table.name, tuple(column.key for column in columns), limit)
+        if key not in self.loaders:
+            self.loaders[key] = Loader(self, table, columns, limit)
+        return self.loaders[key]
+
+
+def check_limit(limit: Any) -> int:
+    if (
+        not isinstance(limit, int)
+        or isinstance(limit, bool)
+        or not 0 < limit <= settings.max_page_lenght
+    ):
+        raise GraphQLError(f"limit must be between 1 and {settings.max_page_lenght}")
+    return limit
+
+
+def list_resolver(table: Table) -> Callable:
+    async def resolve(root, info, limit: int, offset: int, **filters):
+        check_limit(limit)
+        if offset < 0:
+            raise GraphQLError("offset must not be negative")
+        statement = (
+            select(*table.columns)
+            .order_by(*table.primary_key.columns)
+            .limit(limit)
+            .offset(offset)
+        )
+        for k, value in filters.items():
+            statement = statement.where(table.columns[k] == value)
+        return await info.context.fetch(statement)
+
+    return resolve
+
+
+def one_resolver(table: Table) -> Callable:
+    async def resolve(root, info, **pks):
+        key = tuple(pks[column.key] for column in table.primary_key.columns)
+        rows = await info.context.loader(table, list(table.primary_key.columns)).load(
+            key
+        )
+        return rows[0] if rows else None
+
+    return resolve
+
+
+def relationship_resolver(
+    table: Table, pairs: List[Tuple[Column, Column]], many: bool
+) -> Callable:
+    def resolve(row, info, limit: int | None = None):
+        key = tuple(row[local.key] for local, _ in pairs)
+        if any(value is None for value in key):
+            return [] if many else None
+        columns = [remote for _, remote in pairs]
+        if many:
+            return info.context.loader(table, columns, check_limit(limit)).load(key)
+        return _first(info.context.loader(table, columns).load(key))
+
+    return resolve
+
+
+async def _first(future: asyncio.Future):
+    rows = await future
+    return rows[0] if rows else None
+
+
+def build_schema():
+    """Generate the GraphQL schema from the tables and relationships of db.Base."""
+    global schema
+    types: Dict[str, GraphQLObjectType] = {}
+    query_fields: Dict[str, GraphQLField] = {}
+    names = set(RESERVED_NAMES)
+
+    def make_fields(table: Table, orm_class) -> Callable[[], Dict[str, GraphQLField]]:
+        # a thunk, types reference each other through relationships
+        def fields():
+            result = {
+                name: GraphQLField(
+                    scalar_from_column(column), description=column.comment
+                )
+                for name, column in table.columns.items()
+                if name.isidentifier()
+            }
+            for rel in inspect(orm_class).relationships:
+                if rel.direction is RelationshipDirection.MANYTOMANY:
+                    continue
+                target = rel.mapper.local_table
+                many = rel.direction is RelationshipDirection.ONETOMANY
+                type_ = GraphQLNonNull(types[target.name])
+                args = {}
+                if many:
+                    # rows loaded for each parent
+                    args["limit"] = GraphQLArgument(
+                        GraphQLInt, default_value=settings.graphql_collection_size
+                    )
+                result[rel.key] = GraphQLField(
+                    GraphQLNonNull(GraphQLList(type_)) if many else types[target.name],
+                    args=args,
+                    resolve=relationship_resolver(target, rel.local_remote_pairs, many),
+                )
+            return result
+
+        return fields
+
+    for name in db.models_registry:
+        orm_class = db.Base.classes.get(name)
+        table: Table = orm_class.__table__
+        singular = db.inflect.singular_noun(name)
+        types[name] = GraphQLObjectType(
+            type_name(singular, names),
+            make_fields(table, orm_class),
+            description=table.comment,
+        )
+        filters = {
+            k: GraphQLArgument(scalar_from_column(column))
+            for k, column in table.columns.items()
+            if k.isidentifier() and scalar_from_column(column) is not JSONScalar
+        }
+        query_fields[to_camel(name)] = GraphQLField(
+            GraphQLNonNull(GraphQLList(GraphQLNonNull(types[name]))),
+            args={
+                "limit": GraphQLArgument(GraphQLInt, default_value=100),
+                "offset": GraphQLArgument(GraphQLInt, default_value=0),
+                **filters,
+            },
+            resolve=list_resolver(table),
+            description=f"List all {name}",
+        )
+        query_fields[to_camel(singular)] = GraphQLField(
+            types[name],
+            args={
+                k: GraphQLArgument(GraphQLNonNull(scalar_from_column(column)))
+                for k, column in table.primary_key.columns.items()
+            },
+            resolve=one_resolver(table),
+            description=f"Get one {singular} by primary key",
+        )
+    schema = GraphQLSchema(GraphQLObjectType("Query", query_fields))
+
+
+def query_cost(
+    selection_set: SelectionSetNode,
+    parent_type: GraphQLObjectType,
+    fragments: Dict[str, FragmentDefinitionNode],
+    variables: Dict[str, Any],
+    depth: int = 1,
+) -> Tuple[int, int]:
+    """Estimated rows and maximum depth of a selection.
+
+    Each object costs one, multiplied by the number of objects its parents may
+    return: the ``limit`` argument of lists, ``graphql_collection_size`` by
+    default for related collections. Invalid limits raise a GraphQLError.
+    """
+    cost, max_depth = 0, depth
+    for selection in selection_set.selections:
+        if isinstance(selection, FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment is None:
+                continue
+            selection = fragment
+        if not isinstance(selection, FieldNode):
+            # inline fragments and fragment definitions
+            sub_cost, sub_depth = query_cost(
+                selection.selection_set, parent_type, fragments, variables, depth
+            )
+            cost, max_depth = cost + sub_cost, max(max_depth, sub_depth)
+            continue
+        field = parent_type.fields.get(selection.name.value)
+        if field is None or selection.selection_set is None:
+            continue
+        size = 1
+        if isinstance(get_nullable_type(field.type), GraphQLList):
+            size = settings.graphql_collection_size
+            if "limit" in field.args:
+                size = field.args["limit"].default_value
+            for argument in selection.arguments or ():
+                if argument.name.value == "limit":
+                    value = value_from_ast_untyped(argument.value, variables)
+                    size = size if value is None else check_limit(value)
+        sub_cost, sub_depth = query_cost(
+            selection.selection_set,
+            get_named_type(field.type),
+            fragments,
+            variables,
+            depth + 1,
+        )
+        cost += size * (1 + sub_cost)
+        max_depth = max(max_depth, sub_depth)
+    return cost, max_depth
+
+
+def check_limits(document, variables: Dict[str, Any]) -> List[GraphQLError]:
+    fragments = {
+        d.name.value: d
+        for d in document.definitions
+        if isinstance(d, FragmentDefinitionNode)
+    }
+    errors = []
+    for definition in document.definitions:
+        if not isinstance(definition, OperationDefinitionNode):
+            continue
+        try:
+            cost, depth = query_cost(
+                definition.selection_set, schema.query_type, fragments, variables
+            )
+        except GraphQLError as e:
+            errors.append(e)
+            continue
+        if depth > settings.graphql_max_depth:
+            errors.append(
+                GraphQLError(
+                    f"Query depth {depth} exceeds {settings.graphql_max_depth}"
+                )
+            )
+        if cost > settings.graphql_max_cost:
+            errors.append(
+                GraphQLError(f"Query cost {cost} exceeds {settings.graphql_max_cost}")
+            )
+    return errors
+
+
+async def endpoint(
+    query: str = Body(..., embed=True),
+    variables: Dict[str, Any] | None = Body(None, embed=True),
+    operation_name: str | None = Body(None, embed=True, alias="operationName"),
+    session: AsyncSession = Depends(db.get_async_session),
+    role: str = Depends(db.get_role),
+):
+    try:
+        document = parse(query)
+    except GraphQLError as e:
+        return JSONResponse({"errors": [e.formatted]}, status_code=400)
+    variables = variables or {}
+    errors = validate(schema, document) or check_limits(document, variables)
+    if errors:
+        return JSONResponse({"errors": [e.formatted for e in errors]}, status_code=400)
+    await db.set_identity(await session.connection(), role)
+    result = await execute(
+        schema,
+        document,
+        context_value=Context(session),
+        variable_values=variables,
+        operation_name=operation_name,
+    )
+    return JSONResponse(result.formatted)
+
+
+def add_route(app: FastAPI):
+    build_schema()
+    app.add_api_route(
+        "/api/graphql",
+        endpoint,
+        summary="GraphQL endpoint",
+        operation_id="graphql",
+        methods=["POST"],
+        tags=["graphql"],
+    )
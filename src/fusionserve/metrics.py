@@ -0,0 +1,234 @@
+import time
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+
+statement_cache_hits = Counter(
+    "fusionserve_statement_cache_hits",
+    "Generated statements found in the statement cache",
+    ["table"],
+)
+statement_cache_misses = Counter(
+    "fusionserve_statement_cache_misses",
+    "Generated statements built because they were not in the statement cache",
+    ["table"],
+)
+
+response_cache_hits = Counter(
+    "fusionserve_response_cache_hits",
+    "GET responses served from the response cache",
+    ["table"],
+)
+response_cache_misses = Counter(
+    "fusionserve_response_cache_misses",
+    "GET responses not found in the response cache",
+    ["table"],
+)
+response_cache_bytes = Gauge(
+    "fusionserve_response_cache_bytes", "Size of the bodies in the response cache"
+)
+
+coalesced_requests = Counter(
+    "fusionserve_coalesced_requests",
+    "Requests answered with the result of an identical request in flight",
+    ["table"],
+)
+
+change_feed_subscribers = Gauge(
+    "fusionserve_change_feed_subscribers", "Clients subscribed to change feeds"
+)
+change_feed_overflows = Counter(
+    "fusionserve_change_feed_overflows",
+    "Change feed subscribers disconnected for falling behind",
+    ["table"],
+)
+slow_queries = Counter(
+    "fusionserve_slow_queries",
+    "Statements of the read routes slower than slow_query_threshold",
+    ["table"],
+)
+
+replica_lag_seconds = Gauge(
+    "fusionserve_replica_lag_seconds",
+    "Replication lag of each read replica, as of its last check",
+    ["replica"],
+)
+replica_healthy = Gauge(
+    "fusionserve_replica_healthy",
+    "Whether each read replica is used, 1, or skipped, 0",
+    ["replica"],
+)
+
+pool_checkout_seconds = Histogram(
+    "fusionserve_pool_checkout_seconds",
+    "Time waited for a pooled database connection, including new connections",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+pool_checked_out = Gauge("fusionserve_pool_checked_out", "Database connections in use")
+pool_idle = Gauge("fusionserve_pool_idle", "Database connections idle in the pool")
+pool_limit = Gauge(
+    "fusionserve_pool_limit",
+    "Maximum database connections of the pool, pool_size plus pool_max_overflow",
+)
+
+# labels are the route template and operation id, never the actual path
+request_seconds = Histogram(
+    "fusionserve_request_seconds",
+    "Time to handle a request, until the last byte of the response is sent",
+    ["route", "operation_id"],
+)
+request_db_seconds = Histogram(
+    "fusionserve_request_db_seconds",
+    "Time spent executing database statements while handling a request",
+    ["route", "operation_id"],
+)
+request_serialization_seconds = Histogram(
+    "fusionserve_request_serialization_seconds",
+    "Request time outside database statements: validation, serialization, sending",
+    ["route", "operation_id"],
+)
+response_rows = Histogram(
+    "fusionserve_response_rows",
+    "Rows returned by a request",
+    ["route", "operation_id"],
+    buckets=(0, 1, 10, 100, 1000, 10_000, 100_000, 1_000_000),
+)
+response_bytes = Histogram(
+    "fusionserve_response_bytes",
+    "Size of the serialized response body, before compression",
+    ["route", "operation_id"],
+    buckets=(100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000),
+)
+request_errors = Counter(
+    "fusionserve_request_errors",
+    "Requests answered with an error status",
+    ["route", "operation_id", "status"],
+)
+
+# accumulators of the request being handled, filled by the database events and
+# by the endpoints
+request_stats: ContextVar[dict | None] = ContextVar("request_stats", default=None)
+
+
+def record_rows(rows: int):
+    stats = request_stats.get()
+    if stats is not None:
+        stats["rows"] = (stats["rows"] or 0) + rows
+
+
+def record_time(phase: str, seconds: float):
+    """Add ``seconds`` to a phase of the request, ``pool`` or ``identity``."""
+    stats = request_stats.get()
+    if stats is not None:
+        stats[phase] += seconds
+
+
+def record_cache(result: str):
+    stats = request_stats.get()
+    if stats is not None:
+        stats["cache"] = result
+
+
+def server_timing(stats: dict, elapsed: float) -> str:
+    """Server-Timing header of a request, in milliseconds.
+
+    ``db`` is the time spent executing statements, except setting the role,
+    ``app`` everything else until the response starts: routing, validation,
+    building the statements and the response.
+    """
+    phases = [
+        f"pool;dur={stats['pool'] * 1000:.1f}",
+        f"identity;dur={stats['identity'] * 1000:.1f}",
+        f"db;dur={(stats['db'] - stats['identity']) * 1000:.1f}"
+        f';desc="{stats["statements"]} statements"',
+        f"app;dur={(elapsed - stats['db'] - stats['pool']) * 1000:.1f}",
+        f"total;dur={elapsed * 1000:.1f}",
+    ]
+    if stats["cache"] is not None:
+        phases.append(f'cache;desc="{stats["cache"]}"')
+    return ", ".join(phases)
+
+
+def instrument(engine: AsyncEngine):
+    """Add the execution time of every statement of ``engine`` to the request."""
+
+    # kept on the execution context, dropped with it when the statement fails
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        context.fusionserve_query_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - context.fusionserve_query_start
+        stats = request_stats.get()
+        if stats is not None:
+            stats["db"] += elapsed
+            stats["statements"] += 1
+
+
+class MetricsMiddleware:
+    """Record latency, database time, rows and bytes of each request.
+
+    Pure ASGI, so that streamed responses are measured until their end. With
+    ``server_timing``, responses tell the time spent in each phase until they
+    start in a Server-Timing header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = {
+            "db": 0.0,
+            "pool": 0.0,
+            "identity": 0.0,
+            "statements": 0,
+            "cache": None,
+            "rows": None,
+            "bytes": 0,
+            "status": 500,
+        }
+        token = request_stats.set(stats)
+
+        async def send_and_count(message):
+            if message["type"] == "http.response.start":
+                stats["status"] = message["status"]
+                if settings.server_timing:
+                    timing = server_timing(stats, time.perf_counter() - start)
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", ()),
+                            (b"server-timing", timing.encode()),
+                        ],
+                    }
+            elif message["type"] == "http.response.body":
+                stats["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_count)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            # set by the router once the request is matched
+            route = scope.get("route")
+            labels = (
+                getattr(route, "path", "unmatched"),
+                getattr(route, "operation_id", None) or getattr(route, "name", ""),
+            )
+            request_seconds.labels(*labels).observe(elapsed)
+            request_db_seconds.labels(*labels).observe(stats["db"])
+            request_serialization_seconds.labels(*labels).observe(elapsed - stats["db"])
+            response_bytes.labels(*labels).observe(stats["bytes"])
+            if stats["rows"] is not None:
+                response_rows.labels(*labels).observe(stats["rows"])
+            if stats["status"] >= 400:
+                request_errors.labels(*labels, stats["status"]).inc()
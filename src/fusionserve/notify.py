@@ -0,0 +1,82 @@
+import asyncio
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+import asyncpg
+
+from .config import logger as _logger
+
+# seconds to wait before connecting again after the LISTEN connection is lost
+RETRY_DELAY = 5
+
+
+class Listener:
+    """A single LISTEN connection per worker, shared by every channel.
+
+    Callbacks run on the event loop for each notification and must be quick:
+    anything slow should be handed over to a task. Notifications sent while the
+    connection is down are lost, ``on_reconnect`` callbacks are called once the
+    connection is back so that subscribers can resynchronize.
+    """
+
+    def __init__(self):
+        self.dsn: str = None
+        self.callbacks: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        self.on_reconnect: List[Callable[[], None]] = []
+        self.connection: asyncpg.Connection = None
+        self._task: asyncio.Task = None
+
+    async def listen(self, channel: str, callback: Callable[[str], None]):
+        first = channel not in self.callbacks
+        self.callbacks[channel].append(callback)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        elif first and self.connection is not None:
+            await self.connection.add_listener(channel, self._dispatch)
+
+    async def unlisten(self, channel: str, callback: Callable[[str], None]):
+        self.callbacks[channel].remove(callback)
+        if not self.callbacks[channel]:
+            del self.callbacks[channel]
+            if self.connection is not None:
+                await self.connection.remove_listener(channel, self._dispatch)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _dispatch(self, connection, pid, channel, payload):
+        for callback in list(self.callbacks.get(channel, ())):
+            try:
+                callback(payload)
+            except Exception:
+                _logger.exception(f"Error handling notification on {channel}")
+
+    async def _run(self):
+        connected_before = False
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                for channel in list(self.callbacks):
+                    await connection.add_listener(channel, self._dispatch)
+                self.connection = connection
+                if connected_before:
+                    _logger.info("LISTEN connection reestablished")
+                    for callback in self.on_reconnect:
+                        callback()
+                connected_before = True
+                await closed.wait()
+            except (OSError, asyncpg.PostgresError) as e:
+                _logger.warning(f"LISTEN connection failed: {e}")
+            finally:
+                self.connection = None
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(RETRY_DELAY)
+
+
+listener = Listener()
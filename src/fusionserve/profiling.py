@@ -0,0 +1,83 @@
+import cProfile
+import os
+import re
+import time
+from pathlib import Path
+
+from starlette.requests import Request
+
+from . import db
+from .config import logger as _logger
+from .config import settings
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pragma: no cover
+    # call tree profiles need the `profile` extra, cProfile is used instead
+    Profiler = None
+
+PROFILE_HEADER = b"x-profile"
+
+
+class ProfileMiddleware:
+    """Profile the requests sent with an ``X-Profile`` header.
+
+    Only for the roles listed in ``profile_roles``, one request at a time per
+    worker. With pyinstrument the profile is a sampled call tree, written as
+    HTML, that follows the request across its awaits. Otherwise it is cProfile
+    statistics, which also count whatever else the event loop runs
+    meanwhile. The file is written to ``profile_dir``, its name is sent back in
+    the ``X-Profile`` response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = False
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not settings.profile_roles
+            or self.busy
+            or PROFILE_HEADER not in dict(scope["headers"])
+            or await db.get_role(Request(scope)) not in settings.profile_roles
+        ):
+            return await self.app(scope, receive, send)
+        self.busy = True
+        route = re.sub(r"[^A-Za-z0-9_.-]+", "_", scope["path"])[:100]
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{scope['method']}"
+        name += f"{route}.{'html' if Profiler else 'prof'}"
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", ()),
+                        (PROFILE_HEADER, name.encode()),
+                    ],
+                }
+            await send(message)
+
+        path = Path(settings.profile_dir) / name
+        if Profiler is not None:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if Profiler is not None:
+                    profiler.stop()
+                    path.write_text(profiler.output_html())
+                else:
+                    profiler.disable()
+                    profiler.dump_stats(path)
+            except OSError as e:
+                _logger.warning(f"Unable to write the profile {path}: {e}")
+            finally:
+                self.busy = False
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+from fastapi import FastAPI
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from . import cache, db, feeds, gql
+from .config import logger as _logger
+from .config import settings
+from .notify import listener
+
+DDL_CHANNEL = "fusionserve_ddl"
+
+# Sends the schema and identity of every object touched by a DDL command
+NOTIFY_DDL_FUNCTION = text(
+    f"""
+    CREATE OR REPLACE FUNCTION public.fusionserve_notify_ddl()
+    RETURNS event_trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        obj record;
+    BEGIN
+        IF TG_EVENT = 'sql_drop' THEN
+            FOR obj IN SELECT * FROM pg_event_trigger_dropped_objects() LOOP
+                PERFORM pg_notify('{DDL_CHANNEL}', json_build_object(
+                    'schema', obj.schema_name, 'object', obj.object_identity
+                )::text);
+            END LOOP;
+        ELSE
+            FOR obj IN SELECT * FROM pg_event_trigger_ddl_commands() LOOP
+                PERFORM pg_notify('{DDL_CHANNEL}', json_build_object(
+                    'schema', obj.schema_name, 'object', obj.object_identity
+                )::text);
+            END LOOP;
+        END IF;
+    END $$
+    """
+)
+
+# Event triggers have no CREATE OR REPLACE, and every worker runs this at startup
+CREATE_EVENT_TRIGGERS = text(
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT FROM pg_event_trigger WHERE evtname = 'fusionserve_ddl_end'
+        ) THEN
+            CREATE EVENT TRIGGER fusionserve_ddl_end ON ddl_command_end
+            EXECUTE FUNCTION public.fusionserve_notify_ddl();
+        END IF;
+        IF NOT EXISTS (
+            SELECT FROM pg_event_trigger WHERE evtname = 'fusionserve_sql_drop'
+        ) THEN
+            CREATE EVENT TRIGGER fusionserve_sql_drop ON sql_drop
+            EXECUTE FUNCTION public.fusionserve_notify_ddl();
+        END IF;
+    END $$
+    """
+)
+
+_task: asyncio.Task = None
+
+
+async def install_event_triggers():
+    try:
+        async with db.role_connection(None) as conn:
+            await conn.execute(NOTIFY_DDL_FUNCTION)
+            await conn.execute(CREATE_EVENT_TRIGGERS)
+            await conn.commit()
+    except DBAPIError as e:
+        # creating event triggers requires a superuser, who may install them once
+        _logger.warning(f"Unable to install the DDL event triggers: {e}")
+
+
+async def _reload_loop(app: FastAPI, pending: asyncio.Event):
+    while True:
+        await pending.wait()
+        # a migration runs many DDL commands: wait for it to settle
+        await asyncio.sleep(settings.schema_reload_delay)
+        pending.clear()
+        try:
+            await db.reload_routes(app)
+            gql.build_schema()
+            if settings.response_cache:
+                # new tables need their change trigger
+                await cache.install_change_triggers()
+            if settings.change_feeds:
+                await feeds.install_row_triggers()
+        except Exception:
+            _logger.exception("Schema reload failed, serving the previous schema")
+
+
+async def start(app: FastAPI):
+    """Reload the routes of the tables changed by DDL, without restarting."""
+    global _task
+    await install_event_triggers()
+    pending = asyncio.Event()
+
+    def on_ddl(payload: str):
+        if json.loads(payload)["schema"] == settings.pg_app_schema:
+            pending.set()
+
+    await listener.listen(DDL_CHANNEL, on_ddl)
+    # changes made while the connection was down have not been notified
+    listener.on_reconnect.append(pending.set)
+    _task = asyncio.create_task(_reload_loop(app, pending))
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+from typing import List
+
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from . import cache, db, metrics
+from .config import logger as _logger
+from .config import settings
+
+# echoed by clients on reads to see their own writes
+LSN_HEADER = "X-LSN"
+
+# A replica that has replayed everything it received is as fresh as it can be,
+# even if the primary has been idle since its last transaction
+REPLICA_STATUS = text(
+    """
+    SELECT pg_last_wal_replay_lsn()::text,
+        CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """
+)
+
+CURRENT_LSN = text("SELECT pg_current_wal_lsn()::text")
+
+
+def parse_lsn(lsn: str) -> int:
+    """Position of a textual LSN, e.g. 16/B374D848, in the write ahead log."""
+    high, low = lsn.split("/")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+class Replica:
+    def __init__(self, address: str):
+        host, _, port = address.partition(":")
+        self.name = address
+        self.engine = db.create_engine(host, int(port or settings.pg_port))
+        self.read_engine = self.engine.execution_options(isolation_level="AUTOCOMMIT")
+        self.healthy = False
+        # replayed position, as of the last check: only ever behind the actual one
+        self.lsn = 0
+
+    def connections(self) -> int:
+        return self.engine.pool.checkedout()
+
+
+class ReplicaSet:
+    """Read replicas serving the read routes, checked in the background.
+
+    A replica is used while its replication lag stays below
+    ``replica_max_lag`` seconds; when no replica qualifies, reads go to the
+    primary. A request carrying the LSN returned by a write only goes to the
+    replicas that already replayed it.
+    """
+
+    def __init__(self):
+        self.replicas: List[Replica] = []
+        self._round_robin = itertools.count()
+        self._task: asyncio.Task = None
+
+    def pick(self, min_lsn: int = 0) -> Replica | None:
+        candidates = [r for r in self.replicas if r.healthy and r.lsn >= min_lsn]
+        if not candidates:
+            return None
+        if settings.replica_selection == "round_robin":
+            return candidates[next(self._round_robin) % len(candidates)]
+        return min(candidates, key=lambda r: r.connections())
+
+    async def _status(self, replica: Replica):
+        async with replica.read_engine.connect() as conn:
+            return (await conn.execute(REPLICA_STATUS)).one()
+
+    async def check(self, replica: Replica):
+        try:
+            lsn, lag = await asyncio.wait_for(
+                self._status(replica), settings.replica_check_interval
+            )
+        except (OSError, DBAPIError, asyncio.TimeoutError) as e:
+            if replica.healthy:
+                _logger.warning(f"Replica {replica.name} unavailable: {e}")
+            replica.healthy = False
+            metrics.replica_healthy.labels(replica.name).set(0)
+            return
+        if lsn is None:
+            # not in recovery: a promoted replica has no lag to measure
+            lag = 0.0
+        else:
+            replica.lsn = parse_lsn(lsn)
+        if lag is None:
+            # no transaction replayed since it started, its lag is unknown
+            metrics.replica_lag_seconds.labels(replica.name).set(float("nan"))
+            healthy = False
+        else:
+            metrics.replica_lag_seconds.labels(replica.name).set(lag)
+            healthy = lag <= settings.replica_max_lag
+        if healthy != replica.healthy:
+            behind = "an unknown time" if lag is None else f"{lag:.1f}s"
+            _logger.info(
+                f"Replica {replica.name} {'in use' if healthy else 'lagging'},"
+                f" {behind} behind"
+            )
+        replica.healthy = healthy
+        metrics.replica_healthy.labels(replica.name).set(int(healthy))
+
+    async def check_all(self):
+        results = await asyncio.gather(
+            *[self.check(r) for r in self.replicas], return_exceptions=True
+        )
+        for replica, result in zip(self.replicas, results):
+            if isinstance(result, Exception):
+                # the checks must go on, or the replica keeps its last state
+                _logger.error(f"Check of replica {replica.name} failed: {result}")
+                replica.healthy = False
+                metrics.replica_healthy.labels(replica.name).set(0)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.replica_check_interval)
+            await self.check_all()
+
+    async def start(self):
+        self.replicas = [Replica(address) for address in settings.pg_replicas]
+        if self.replicas:
+            # a change is notified before replicas replay it, a response computed
+            # on a replica meanwhile would be cached stale
+            cache.response_cache.settle = (
+                settings.replica_max_lag + settings.replica_check_interval
+            )
+        await self.check_all()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+        self.replicas = []
+
+
+replica_set = ReplicaSet()
+
+
+def read_engine(request: Request) -> AsyncEngine:
+    """Engine for the reads of ``request``, a replica when one can serve it."""
+    min_lsn = 0
+    hint = request.headers.get(LSN_HEADER)
+    if hint:
+        try:
+            min_lsn = parse_lsn(hint)
+        except ValueError:
+            pass
+    replica = replica_set.pick(min_lsn)
+    return db.read_engine if replica is None else replica.read_engine
+
+
+async def write_headers(conn: AsyncConnection) -> dict:
+    """Headers of a committed write: the LSN to read it back from replicas."""
+    if not replica_set.replicas:
+        return {}
+    # read after the commit, so that it is past the end of the commit record
+    return {LSN_HEADER: await conn.scalar(CURRENT_LSN)}
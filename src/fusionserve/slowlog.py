@@ -0,0 +1,155 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Annotated, Any, Dict, List, Tuple
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from sqlalchemy import Select
+from sqlalchemy.exc import DBAPIError
+
+from . import db, metrics, replicas
+from .config import logger as _logger
+from .config import settings
+from .statements import Explain
+
+
+class SlowQuery:
+    """Slow executions of a statement, by table, role and SQL text."""
+
+    def __init__(self, table: str, role: str, sql: str, parameters: Dict[str, str]):
+        self.table = table
+        self.role = role
+        self.sql = sql
+        self.parameters = parameters
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_seen: float = None
+        self.plan: Any = None
+        self.plan_at: float = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "table": self.table,
+            "role": self.role,
+            "sql": self.sql,
+            "parameters": self.parameters,
+            "calls": self.calls,
+            "total_time": self.total_time,
+            "mean_time": self.total_time / self.calls,
+            "max_time": self.max_time,
+            "last_seen": self.last_seen,
+            "plan": self.plan,
+            "plan_at": self.plan_at,
+        }
+
+
+class SlowQueryLog:
+    """Statements of the read routes slower than ``slow_query_threshold``.
+
+    Each slow execution is logged with the SQL text, the types of its
+    parameters, the table and the role, and added up by statement, least
+    recently slow first out. The plan of a slow statement is captured in the
+    background with EXPLAIN ANALYZE, which runs the statement again: one at a
+    time, and at most once per ``slow_query_explain_interval`` for the same
+    statement.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Tuple[str, str, str], SlowQuery] = OrderedDict()
+        self._explaining: asyncio.Task = None
+
+    def observe(
+        self,
+        table_name: str,
+        role: str,
+        statement: Select,
+        params: Dict[str, Any],
+        elapsed: float,
+    ):
+        threshold = settings.slow_query_threshold
+        if not threshold or elapsed < threshold:
+            return
+        # values are bound parameters, the SQL text is the same for every call
+        sql = str(statement.compile(dialect=db.engine.dialect))
+        parameters = {k: type(value).__name__ for k, value in params.items()}
+        metrics.slow_queries.labels(table_name).inc()
+        _logger.warning(
+            f"Slow query on {table_name} as {role}: {elapsed:.3f}s, "
+            f"parameters {parameters}\n{sql}"
+        )
+        key = (table_name, role, sql)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = SlowQuery(table_name, role, sql, parameters)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(key)
+        entry.calls += 1
+        entry.total_time += elapsed
+        entry.max_time = max(entry.max_time, elapsed)
+        entry.last_seen = time.time()
+        interval = settings.slow_query_explain_interval
+        if (
+            interval
+            and self._explaining is None
+            and (entry.plan_at is None or entry.last_seen - entry.plan_at >= interval)
+        ):
+            entry.plan_at = entry.last_seen
+            self._explaining = asyncio.create_task(
+                self.explain(entry, statement, params)
+            )
+
+    async def explain(self, entry: SlowQuery, statement: Select, params: dict):
+        """Capture the plan of ``entry``, as its role, on a replica if any."""
+        # not part of the request that triggered it, which may be over by now
+        metrics.request_stats.set(None)
+        replica = replicas.replica_set.pick()
+        engine = db.read_engine if replica is None else replica.read_engine
+        try:
+            async with engine.connect() as conn:
+                await db.set_identity(conn, entry.role)
+                plan = await conn.scalar(Explain(statement, analyze=True), params)
+            entry.plan = json.loads(plan) if isinstance(plan, str) else plan
+            _logger.info(
+                f"Plan of a slow query on {entry.table} as {entry.role}: "
+                f"{json.dumps(entry.plan)}"
+            )
+        except (OSError, DBAPIError) as e:
+            _logger.warning(f"Unable to explain a slow query on {entry.table}: {e}")
+        finally:
+            self._explaining = None
+
+    def top(self, limit: int) -> List[SlowQuery]:
+        return sorted(self.entries.values(), key=lambda e: -e.total_time)[:limit]
+
+    def clear(self):
+        self.entries.clear()
+
+
+slow_queries = SlowQueryLog(settings.statement_cache_size)
+
+
+async def endpoint(request: Request, limit: Annotated[int, Query(ge=1, le=1000)] = 20):
+    # not a dependency: db imports this module
+    if await db.get_role(request) not in settings.admin_roles:
+        raise HTTPException(403, "Reserved to the admin roles")
+    return [entry.as_dict() for entry in slow_queries.top(limit)]
+
+
+def add_route(app: FastAPI):
+    app.add_api_route(
+        "/api/$slow-queries",
+        endpoint,
+        summary="Slowest statements of the read routes",
+        description=(
+            "Statements of the list and get routes slower than "
+            "`slow_query_threshold`, by total time, with their plan as captured "
+            "by EXPLAIN ANALYZE. Reserved to the roles in `admin_roles`."
+        ),
+        operation_id="slow_queries",
+        methods=["GET"],
+        tags=["admin"],
+    )
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Dict
+
+import sqlalchemy
+from sqlalchemy import MetaData, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import __version__
+from .config import logger as _logger
+from .config import settings
+
+# Everything metadata.reflect() reads for the tables of a schema, one digest per
+# table. A digest changes whenever a column, default, comment, constraint or index
+# of the table is added, dropped or altered. Enum labels are schema wide and are
+# reported under the empty table name.
+CATALOG_FINGERPRINT = text(
+    """
+    SELECT relname, md5(string_agg(entry, E'\\n' ORDER BY entry))
+    FROM (
+        SELECT c.relname, concat_ws(
+            ':', a.attnum, a.attname,
+            format_type(a.atttypid, a.atttypmod), a.attnotnull,
+            pg_get_expr(d.adbin, d.adrelid), col_description(c.oid, a.attnum)
+        ) AS entry
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a
+            ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+        WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+        UNION ALL
+        SELECT c.relname, concat_ws(
+            ':', 'comment', obj_description(c.oid, 'pg_class')
+        )
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+        UNION ALL
+        SELECT c.relname, concat_ws(':', co.conname, pg_get_constraintdef(co.oid))
+        FROM pg_constraint co
+        JOIN pg_class c ON c.oid = co.conrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema
+        UNION ALL
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema
+        UNION ALL
+        SELECT '', concat_ws(':', t.typname, e.enumsortorder, e.enumlabel)
+        FROM pg_enum e
+        JOIN pg_type t ON t.oid = e.enumtypid
+        JOIN pg_namespace n ON n.oid = t.typnamespace
+        WHERE n.nspname = :schema
+    ) AS entries
+    GROUP BY relname
+    """
+)
+
+
+async def table_fingerprints(conn: AsyncConnection, schema: str) -> Dict[str, str]:
+    """Catalog digest of every table of ``schema``, by table name."""
+    return dict((await conn.execute(CATALOG_FINGERPRINT, {"schema": schema})).all())
+
+
+def fingerprint(digests: Dict[str, str]) -> str:
+    """Snapshot key for a set of table digests and the code that reads them.
+
+    Library versions are part of the key because pickled metadata is only
+    guaranteed to load with the SQLAlchemy release that produced it.
+    """
+    catalog = ",".join(f"{name}={digest}" for name, digest in sorted(digests.items()))
+    return hashlib.sha1(
+        f"{catalog}:{sqlalchemy.__version__}:{__version__}".encode()
+    ).hexdigest()
+
+
+def _path(schema: str, key: str) -> Path:
+    return Path(settings.schema_snapshot_dir) / f"{schema}-{key}.pickle"
+
+
+def load(schema: str, key: str) -> MetaData | None:
+    path = _path(schema, key)
+    try:
+        with path.open("rb") as f:
+            metadata = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # a truncated or incompatible snapshot is just a cache miss
+        _logger.warning(f"Ignoring unreadable schema snapshot {path}: {e}")
+        return None
+    _logger.info(f"Loaded schema snapshot {path}")
+    return metadata
+
+
+def save(schema: str, key: str, metadata: MetaData):
+    path = _path(schema, key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write and rename, so that concurrent workers never read a partial file
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        for stale in path.parent.glob(f"{schema}-*.pickle"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+    except OSError as e:
+        # e.g. a read-only filesystem: startup must not fail because of the cache
+        _logger.warning(f"Unable to write schema snapshot {path}: {e}")
+        return
+    _logger.info(f"Saved schema snapshot {path}")
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from sqlalchemy import Executable, Select, Table
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.sql.visitors import InternalTraversal
+
+from . import metrics
+from .config import settings
+
+
+class StatementCache:
+    """Generated statements by table and shape, least recently used first out.
+
+    A shape is everything that changes the SQL text: the filtered columns, the
+    ordering, whether a cursor is given and so on. Values are bound parameters,
+    so all the requests with the same shape execute the very same statement
+    object: SQLAlchemy skips building and compiling it (its cache key is
+    memoized) and asyncpg finds it among its prepared statements.
+
+    Entries are keyed by the Table object, not its name: a request still
+    running on the routes replaced by a reload builds statements of the old
+    table, that the new routes must not execute.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Hashable, Executable] = OrderedDict()
+
+    def get(self, table: Table, shape: Hashable, build: Callable[[], Executable]):
+        key = (table, shape)
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            metrics.statement_cache_misses.labels(table.name).inc()
+            self.entries[key] = build()
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        else:
+            metrics.statement_cache_hits.labels(table.name).inc()
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+statement_cache = StatementCache(settings.statement_cache_size)
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a select, with the same bound parameters.
+
+    With ``analyze`` the select is executed, and the plan reports the actual
+    rows, timings and buffers of each node.
+    """
+
+    inherit_cache = True
+    _traverse_internals = [
+        ("statement", InternalTraversal.dp_clauseelement),
+        ("analyze", InternalTraversal.dp_boolean),
+    ]
+
+    def __init__(self, statement: Select, analyze: bool = False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element: Explain, compiler, **kw) -> str:
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if element.analyze else "FORMAT JSON"
+    return f"EXPLAIN ({options}) {compiler.process(element.statement, **kw)}"
@@ -0,0 +1,84 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from fusionserve import batch, db
+from fusionserve.batch import BatchRequest, SubRequest, _response, _scope
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_scope():
+    """Sub-requests inherit the headers of the batch, and may override them"""
+    request = Request(
+        {
+            "type": "http",
+            "headers": [(b"authorization", b"a"), (b"content-length", b"10")],
+        }
+    )
+    sub = SubRequest(
+        method="POST", url="/api/jobs?x=1", headers={"Authorization": "b"}, body={}
+    )
+    scope = _scope(request, sub)
+    assert scope["path"] == "/api/jobs" and scope["query_string"] == b"x=1"
+    assert scope["headers"] == [
+        (b"authorization", b"b"),
+        (b"content-type", b"application/json"),
+    ]
+    for url in ("/metrics", "http://host/api/jobs", "/api/$batch", "/api/x/changes"):
+        with pytest.raises(HTTPException):
+            _scope(request, SubRequest(method="GET", url=url))
+
+
+def test_response():
+    """JSON bodies are embedded as is, others as strings"""
+    json_headers = {"content-type": "application/json"}
+    assert json.loads(_response(200, json_headers, b'[{"id": 1}]'))["body"] == [
+        {"id": 1}
+    ]
+    assert json.loads(_response(200, {}, b"a,b\n"))["body"] == "a,b\n"
+    assert json.loads(_response(424, {}, b""))["body"] is None
+
+
+class FakeConnection:
+    def __init__(self):
+        self.info = {}
+
+    async def execute(self, statement, params=None):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+def test_failed_batch_identity(monkeypatch):
+    """A batch rolled back does not leave its role recorded on the connection"""
+    conn = FakeConnection()
+
+    @asynccontextmanager
+    async def connect():
+        yield conn
+
+    async def dispatch(request, sub):
+        return 400, {}, b""
+
+    monkeypatch.setattr(db, "engine", SimpleNamespace(connect=connect))
+    monkeypatch.setattr(batch, "dispatch", dispatch)
+    request = Request({"type": "http", "headers": []})
+    sub = SubRequest(method="POST", url="/api/jobs", body={})
+    atomic = BatchRequest(requests=[sub, sub], atomic=True)
+    response = asyncio.run(batch.endpoint(request, atomic, "reader"))
+    assert json.loads(response.body)["committed"] is False
+    assert "identity" not in conn.info
+    asyncio.run(batch.endpoint(request, BatchRequest(requests=[sub]), "reader"))
+    assert conn.info["identity"] == ("reader", "")
@@ -0,0 +1,162 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import JSON, Column, Integer, MetaData, String, Table, bindparam
+from sqlalchemy.dialects import postgresql
+
+from fusionserve import bulk
+from fusionserve.bulk import BulkChange, BulkInsert, _join
+from fusionserve.config import settings
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def table():
+    return Table(
+        "jobs",
+        MetaData(schema="app_public"),
+        Column("id", Integer, primary_key=True),
+        Column("queue", String),
+        Column("payload", JSON),
+    )
+
+
+def sql(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+class FakeConnection:
+    """Records the statements, answers each with a JSON array of one row."""
+
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+
+    async def scalar(self, statement, params=None):
+        self.statements.append(statement)
+        return f'[{{"n": {len(self.statements)}}}]'
+
+    async def get_raw_connection(self):
+        async def copy_records_to_table(name, schema_name, columns, records):
+            self.copied.append((schema_name, name, columns, records))
+
+        driver = SimpleNamespace(copy_records_to_table=copy_records_to_table)
+        return SimpleNamespace(driver_connection=driver)
+
+    async def execute(self, statement, params=None):
+        self.statements.append(statement)
+        one = (f'[{{"n": {len(self.statements)}}}]', 2, None)
+        return SimpleNamespace(rowcount=2, one=lambda: one)
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        yield
+
+
+def test_join():
+    """JSON arrays are concatenated, empty ones skipped"""
+    assert _join(['[{"a": 1}]', "[]", '[{"a": 2}, {"a": 3}]']) == (
+        '[{"a": 1}, {"a": 2}, {"a": 3}]'
+    )
+    assert _join([]) == "[]"
+
+
+def test_insert_batches(table, monkeypatch):
+    """Rows are inserted by set of columns, in batches within the parameter limit"""
+    monkeypatch.setattr(bulk, "MAX_PARAMETERS", 4)
+    conn = FakeConnection()
+    insert = BulkInsert(conn, table)
+
+    async def load():
+        for i in range(5):
+            await insert.add({"id": i, "queue": "a"})
+        await insert.add({"id": 5})
+        return await insert.finish(single=False)
+
+    content = asyncio.run(load())
+    # 2 rows of 2 columns per statement, and the row with its own columns
+    assert len(conn.statements) == 4
+    assert [row["n"] for row in json.loads(content)] == [1, 2, 3, 4]
+    assert insert.count == 6 and not conn.copied
+    first = sql(conn.statements[0])
+    assert first.startswith("WITH inserted AS \n(INSERT INTO app_public.jobs")
+    assert "RETURNING app_public.jobs.id, app_public.jobs.queue" in first
+    assert "json_agg(anon_1)" in first and "FROM inserted" in first
+    assert first.count("::INTEGER, %(") == 2
+
+
+def test_copy(table, monkeypatch):
+    """Past the threshold rows are copied, and only counted"""
+    monkeypatch.setattr(settings, "bulk_copy_threshold", 3)
+    conn = FakeConnection()
+    insert = BulkInsert(conn, table)
+
+    async def load():
+        for i in range(4):
+            await insert.add({"id": i, "payload": {"i": i}})
+        return await insert.finish(single=False)
+
+    assert json.loads(asyncio.run(load())) == {"count": 4}
+    assert not conn.statements
+    assert [len(records) for *_, records in conn.copied] == [3, 1]
+    schema, name, columns, records = conn.copied[0]
+    assert (schema, name, columns) == ("app_public", "jobs", ["id", "payload"])
+    # JSON values are sent as text
+    assert records[0] == (0, '{"i": 0}')
+
+
+def test_update_keys(table, monkeypatch):
+    """Rows are updated by primary key from VALUES lists, one per set of columns"""
+    monkeypatch.setattr(bulk, "MAX_PARAMETERS", 4)
+    conn = FakeConnection()
+    change = BulkChange(conn, table, returning=False)
+    rows = [{"id": i, "queue": "a"} for i in range(3)] + [{"id": 3, "payload": {}}]
+    asyncio.run(change.update_keys([], {}, rows, replace=False))
+    assert len(conn.statements) == 3
+    assert json.loads(change.response()) == {"count": 6}
+    statement = sql(conn.statements[0])
+    assert "UPDATE app_public.jobs SET queue=keys.queue FROM (VALUES" in statement
+    assert "AS keys (id, queue) WHERE app_public.jobs.id = keys.id" in statement
+    asyncio.run(change.update_keys([], {}, [{"id": 1}], replace=True))
+    assert "SET queue=DEFAULT, payload=DEFAULT" in sql(conn.statements[-1])
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(change.update_keys([], {}, [{"queue": "a"}], replace=False))
+    assert e.value.status_code == 422
+    with pytest.raises(HTTPException):
+        asyncio.run(change.update_keys([], {}, [{"id": 1}], replace=False))
+
+
+def test_delete_keys(table):
+    """Rows are deleted by joining their keys, changed rows returned as JSON"""
+    conn = FakeConnection()
+    change = BulkChange(conn, table, returning=True)
+    asyncio.run(change.delete_keys([table.c.queue == "a"], {}, [(1,), (2,)]))
+    asyncio.run(change.delete([table.c.queue == "b"], {}))
+    assert change.count == 4
+    assert [row["n"] for row in json.loads(change.response())] == [1, 2]
+    statement = sql(conn.statements[0])
+    assert statement.startswith("WITH changed AS \n(DELETE FROM app_public.jobs USING")
+    assert "WHERE app_public.jobs.id = keys.id AND app_public.jobs.queue" in statement
+    assert "RETURNING app_public.jobs.id" in statement
+
+
+def test_keys_parameters(table, monkeypatch):
+    """The parameters of the filters count toward the limit of each statement"""
+    monkeypatch.setattr(bulk, "MAX_PARAMETERS", 4)
+    conn = FakeConnection()
+    change = BulkChange(conn, table, returning=False)
+    condition = table.c.queue == bindparam("filter_queue")
+    params = {"filter_queue": "a"}
+    asyncio.run(change.delete_keys([condition], params, [(i,) for i in range(4)]))
+    assert len(conn.statements) == 2
+    rows = [{"id": i, "queue": "b"} for i in range(2)]
+    asyncio.run(change.update_keys([condition], params, rows, replace=False))
+    # one row of two columns and the filter per statement
+    assert len(conn.statements) == 4
@@ -0,0 +1,76 @@
+import asyncio
+
+from starlette.requests import Request
+
+from fusionserve import cache
+from fusionserve.cache import Entry, ResponseCache, SingleFlight
+from fusionserve.config import settings
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_response_cache():
+    """Entries are evicted by size and invalidated by table"""
+    cache = ResponseCache(max_bytes=10)
+    for key in "abc":
+        cache.put(key, Entry(b"1234", {}, ("jobs",)), cache.generation(["jobs"]))
+    assert list(cache.entries) == ["b", "c"]
+    tables = ("tasks", "jobs")
+    cache.put("d", Entry(b"1", {}, tables), cache.generation(tables))
+    cache.invalidate("tasks")
+    assert list(cache.entries) == ["b", "c"] and cache.size == 8
+    generation = cache.generation(["jobs"])
+    cache.invalidate("jobs")
+    assert not cache.entries and cache.size == 0
+    # computed before the change: not stored
+    cache.put("e", Entry(b"1", {}, ("jobs",)), generation)
+    assert cache.get("e", "jobs") is None
+
+
+def test_single_flight():
+    """Concurrent calls with the same key run once"""
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(
+            *[flight.run("a", "jobs", call) for _ in range(10)],
+            flight.run("b", "jobs", call),
+        )
+        return results, flight.calls
+
+    results, pending = asyncio.run(main())
+    assert len(calls) == 2 and set(results[:10]) == {results[0]} and not pending
+
+
+def test_enabled(monkeypatch):
+    """Only tables with a change trigger are cached"""
+    monkeypatch.setattr(settings, "response_cache", True)
+    monkeypatch.setattr(cache.response_cache, "watched", {"jobs"})
+    assert cache.enabled(("jobs",))
+    assert not cache.enabled(("jobs", "tasks"))
+
+
+def test_cache_key():
+    """Reads carrying an LSN do not share the responses of the others"""
+
+    def request(headers):
+        return Request(
+            {
+                "type": "http",
+                "path": "/api/jobs",
+                "query_string": b"b=2&a=1",
+                "headers": headers,
+            }
+        )
+
+    key = cache.cache_key(request([]), "reader")
+    assert key == cache.cache_key(request([(b"accept", b"*/*")]), "reader")
+    assert key != cache.cache_key(request([(b"x-lsn", b"0/64")]), "reader")
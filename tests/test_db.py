@@ -0,0 +1,282 @@
+import asyncio
+import uuid
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Integer,
+    MetaData,
+    Numeric,
+    String,
+    Table,
+    bindparam,
+    create_engine,
+    event,
+    select,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.automap import automap_base
+
+from fusionserve import db
+from fusionserve.db import (
+    decode_cursor,
+    encode_cursor,
+    included_tables,
+    json_array,
+    json_array_by_keys,
+    json_object,
+    keyset_condition,
+    list_statement,
+    parse_include,
+    parse_select,
+    reset_identity,
+    set_identity,
+    sort_keys,
+    total_headers,
+)
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def table():
+    return Table(
+        "jobs",
+        MetaData(),
+        Column("id", UUID(as_uuid=True), primary_key=True),
+        Column("queue", String),
+        Column("exit_code", Integer),
+    )
+
+
+@pytest.fixture
+def classes():
+    metadata = MetaData(schema="app_public")
+    Table("jobs", metadata, Column("id", Integer, primary_key=True))
+    Table(
+        "tasks",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("job_id", Integer, ForeignKey("app_public.jobs.id")),
+    )
+    base = automap_base(metadata=metadata)
+    base.prepare()
+    return base.classes
+
+
+def sql(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_sort_keys(table):
+    """Primary key is appended to make the ordering total"""
+    assert sort_keys(table, None) == [(table.c.id, False)]
+    assert sort_keys(table, "queue desc, exit_code") == [
+        (table.c.queue, True),
+        (table.c.exit_code, False),
+        (table.c.id, False),
+    ]
+    with pytest.raises(HTTPException):
+        sort_keys(table, "missing asc")
+    with pytest.raises(HTTPException):
+        sort_keys(table, "queue sideways")
+
+
+def test_cursor(table):
+    """Cursor values are converted back to the column python types"""
+    keys = sort_keys(table, "exit_code desc")
+    job_id = uuid.uuid4()
+    cursor = encode_cursor(f'[3, "{job_id}"]')
+    assert decode_cursor(cursor, keys) == [3, job_id]
+    with pytest.raises(HTTPException):
+        decode_cursor(encode_cursor("[3]"), keys)
+    with pytest.raises(HTTPException):
+        decode_cursor("not a cursor", keys)
+
+
+def test_cursor_numeric():
+    """Numeric cursor values keep their precision"""
+    prices = Table(
+        "prices",
+        MetaData(),
+        Column("amount", Numeric(30, 20), primary_key=True),
+    )
+    keys = sort_keys(prices, None)
+    amount = "1.23456789012345678901"
+    assert decode_cursor(encode_cursor(f"[{amount}]"), keys) == [Decimal(amount)]
+
+
+def test_page_order(table):
+    """Rows and the cursor of a page are aggregated in the order of the sort keys"""
+    keys = sort_keys(table, "queue desc")
+    statement = sql(json_array(select(table), keys))
+    order = "ORDER BY anon_1.queue DESC, anon_1.id ASC)"
+    assert f"coalesce(json_agg(anon_1 {order}" in statement
+    assert f"json_agg(json_build_array(anon_1.queue, anon_1.id) {order}" in statement
+
+
+def test_nullable_keyset(table):
+    """Nulls of a nullable sort key are paginated, after the other values"""
+    keys = sort_keys(table, "queue")
+    job_id = uuid.uuid4()
+    assert decode_cursor(encode_cursor(f'[null, "{job_id}"]'), keys) == [None, job_id]
+    bounds = [bindparam("after_0", type_=String), bindparam("after_1")]
+    sql = str(keyset_condition(keys, bounds).compile(dialect=postgresql.dialect()))
+    assert "jobs.queue IS NULL AND %(after_0)s::VARCHAR IS NOT NULL" in sql
+    assert "jobs.queue IS NOT DISTINCT FROM %(after_0)s::VARCHAR" in sql
+    assert "(jobs.queue, jobs.id) >" not in sql
+
+
+def test_total_headers():
+    """Content-Range has the page bounds when the offset is known"""
+    assert total_headers(42, 10, 5)["Content-Range"] == "items 10-14/42"
+    assert total_headers(42, None, 5) == {
+        "X-Total-Count": "42",
+        "Content-Range": "items */42",
+    }
+    assert total_headers(0, 0, 0)["Content-Range"] == "items */0"
+
+
+def test_parse_select(table):
+    """Selected columns are validated and deduplicated, in the given order"""
+    assert parse_select(table, None) is None
+    assert parse_select(table, "exit_code, queue,exit_code") == ("exit_code", "queue")
+    with pytest.raises(HTTPException):
+        parse_select(table, "queue,missing")
+    with pytest.raises(HTTPException):
+        parse_select(table, " , ")
+
+
+def test_json_numeric(table):
+    """Numerics are sent as strings, as documented by the response models"""
+    sql = str(json_object(select(table)).compile(dialect=postgresql.dialect()))
+    assert "LATERAL" not in sql
+    prices = Table(
+        "prices",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("amount", Numeric(10, 2)),
+    )
+    sql = str(json_object(select(prices)).compile(dialect=postgresql.dialect()))
+    assert "row_to_json(selected)" in sql
+    assert "CAST(anon_1.amount AS TEXT) AS amount" in sql
+
+
+def test_include(classes):
+    """Related records are embedded by subqueries correlated to their parent"""
+    jobs, tasks = classes.jobs, classes.tasks
+    include = parse_include(jobs, "tasks_collection, tasks_collection")
+    assert [rel.key for rel in include] == ["tasks_collection"]
+    assert included_tables(jobs.__table__, include) == ("jobs", "tasks")
+    keys = sort_keys(jobs.__table__, None)
+    statement = sql(list_statement(jobs.__table__, [], keys, False, include))
+    assert "FROM app_public.tasks AS included_tasks_collection \nWHERE " in statement
+    assert "included_tasks_collection.job_id = app_public.jobs.id" in statement
+    assert "ORDER BY included_tasks_collection.id" in statement
+    keys = sort_keys(tasks.__table__, None)
+    include = parse_include(tasks, "jobs")
+    statement = sql(list_statement(tasks.__table__, [], keys, False, include))
+    assert "SELECT row_to_json(included_jobs) AS row_to_json_1" in statement
+    assert "WHERE included_jobs.id = app_public.tasks.job_id" in statement
+    with pytest.raises(HTTPException):
+        parse_include(jobs, "tasks_collection,missing")
+
+
+def test_include_after_reload(classes, monkeypatch):
+    """Routes kept by a reload still correlate the relationships of their table"""
+    jobs = classes.jobs
+    metadata = MetaData(schema="app_public")
+    for table in jobs.__table__.metadata.sorted_tables:
+        table.to_metadata(metadata)
+    # the tables mapped again by a reload are other objects
+    base = automap_base(metadata=metadata)
+    base.prepare()
+    monkeypatch.setattr(db, "Base", base)
+    keys = sort_keys(jobs.__table__, None)
+    include = parse_include(jobs, "tasks_collection")
+    statement = sql(list_statement(jobs.__table__, [], keys, False, include))
+    assert "FROM app_public.tasks AS included_tasks_collection \nWHERE " in statement
+    assert "included_tasks_collection.job_id = app_public.jobs.id" in statement
+
+
+class FakeConnection:
+    def __init__(self):
+        self.info = {}
+        self.params = []
+
+    async def execute(self, statement, params=None):
+        self.params.append(params)
+
+
+def test_identity():
+    """The identity is set once per connection, and reset when returned"""
+    conn = FakeConnection()
+
+    async def run():
+        await set_identity(conn, None)
+        await set_identity(conn, "reader")
+        await set_identity(conn, "reader")
+        await set_identity(conn, "reader", {"sub": "1"})
+        await set_identity(conn, "writer", local=True)
+
+    asyncio.run(run())
+    assert [(p["role"], p["claims"], p["local"]) for p in conn.params] == [
+        ("reader", "", False),
+        ("reader", '{"sub": "1"}', False),
+        ("writer", "", True),
+    ]
+    # a transaction-local identity is not left on the connection
+    assert conn.info["identity"] == ("reader", '{"sub": "1"}')
+    engine = create_engine("sqlite://")
+    event.listen(engine.pool, "reset", reset_identity)
+    configs = []
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function(
+            "set_config", 3, lambda *args: configs.append(args)
+        )
+
+    with engine.connect() as connection:
+        pass
+    assert configs == []
+    with engine.connect() as connection:
+        connection.info["identity"] = ("reader", "")
+    assert configs == [("role", "none", 0), ("request.jwt.claims", "", 0)]
+    with engine.connect() as connection:
+        assert "identity" not in connection.info
+
+
+def test_json_array_by_keys():
+    """Rows are read by unnesting one array of keys per primary key column"""
+    jobs = Table("jobs", MetaData(), Column("id", Integer, primary_key=True))
+    statement = sql(json_array_by_keys(jobs, []))
+    assert "FROM unnest(%(keys_0)s::INTEGER[]) WITH ORDINALITY" in statement
+    assert "AS keys(id, position) LEFT OUTER JOIN" in statement
+    assert "LEFT OUTER JOIN (SELECT jobs.id AS id \nFROM jobs) AS anon_1" in statement
+    assert "ON anon_1.id = keys.id" in statement
+    # missing rows are nulls, in the place of their key
+    assert "json_agg(CASE WHEN (anon_1.id IS NULL) THEN NULL " in statement
+    assert "ELSE row_to_json(anon_1) END ORDER BY keys.position)" in statement
+    links = Table(
+        "links",
+        MetaData(),
+        Column("a", Integer, primary_key=True),
+        Column("b", String, primary_key=True),
+        Column("amount", Numeric(10, 2)),
+    )
+    statement = sql(json_array_by_keys(links, [], ("amount",)))
+    assert "unnest(%(keys_0)s::INTEGER[], %(keys_1)s::VARCHAR[])" in statement
+    assert "WITH ORDINALITY AS keys(a, b, position)" in statement
+    # the keys are joined on even when not selected, and not sent
+    assert "(SELECT links.amount AS amount, links.a AS a, links.b AS b" in statement
+    assert "ON anon_1.a = keys.a AND anon_1.b = keys.b" in statement
+    lateral = "LATERAL (SELECT CAST(anon_1.amount AS TEXT) AS amount) AS selected"
+    assert lateral in statement
+    assert "ELSE row_to_json(selected) END" in statement
@@ -0,0 +1,136 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Numeric,
+    String,
+    Table,
+    select,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import UUID
+from starlette.requests import Request
+
+from fusionserve import export
+from fusionserve.config import settings
+from fusionserve.export import CsvExport, NdjsonExport, arrow_type, negotiate
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+jobs = Table(
+    "jobs",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("queue", String),
+)
+
+
+def sql(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def request(accept: str) -> Request:
+    return Request({"type": "http", "headers": [(b"accept", accept.encode())]})
+
+
+def test_negotiate():
+    """Export formats are chosen by the Accept header, JSON otherwise"""
+    assert negotiate(request("text/csv")) == "text/csv"
+    assert negotiate(request("application/x-ndjson, */*")) == "application/x-ndjson"
+    assert negotiate(request("application/json")) is None
+    assert negotiate(Request({"type": "http", "headers": []})) is None
+
+
+def test_csv():
+    """Values are sent as Postgres text, quoted as needed, after a header"""
+    writer = CsvExport(select(jobs))
+    assert "CAST(anon_1.id AS TEXT) AS id" in sql(writer.statement)
+    assert writer.header() == "id,queue\r\n"
+    assert writer.batch([("1", "a,b"), ("2", None)]) == '1,"a,b"\r\n2,\r\n'
+    assert writer.footer() == ""
+
+
+def test_ndjson():
+    """Rows are serialized by Postgres, one document per line"""
+    writer = NdjsonExport(select(jobs))
+    assert sql(writer.statement).startswith("SELECT CAST(row_to_json(anon_1) AS TEXT)")
+    assert writer.header() == ""
+    assert writer.batch([('{"id": 1}',), ('{"id": 2}',)]) == '{"id": 1}\n{"id": 2}\n'
+
+
+class FakeConnection:
+    def __init__(self, batches):
+        self.batches = batches
+        self.statements = []
+
+    async def stream(self, statement, params):
+        self.statements.append((statement, params))
+
+        async def partitions():
+            for batch in self.batches:
+                yield batch
+
+        return type("Result", (), {"partitions": staticmethod(partitions)})
+
+
+def test_stream(monkeypatch):
+    """Rows are fetched and encoded by batches, on a connection held meanwhile"""
+    monkeypatch.setattr(settings, "export_batch_size", 2)
+    conn = FakeConnection([[("1", "a"), ("2", "b")], [("3", "c")]])
+    events = []
+
+    @asynccontextmanager
+    async def connection():
+        events.append("acquired")
+        yield conn
+        events.append("released")
+
+    async def read():
+        chunks = []
+        async for chunk in export.stream(
+            connection(), select(jobs), {"limit": 10}, "text/csv"
+        ):
+            chunks.append(chunk)
+            events.append("chunk")
+        return chunks
+
+    chunks = asyncio.run(read())
+    assert chunks == ["id,queue\r\n", "1,a\r\n2,b\r\n", "3,c\r\n", ""]
+    # the connection is only acquired once the response starts
+    assert events == ["chunk", "acquired", "chunk", "chunk", "released", "chunk"]
+    statement, params = conn.statements[0]
+    assert statement.get_execution_options()["yield_per"] == 2
+    assert params == {"limit": 10}
+
+
+def test_arrow_type():
+    """Columns get their native Arrow type, or are sent as text"""
+    pa = pytest.importorskip("pyarrow")
+    assert arrow_type(Column("n", Numeric(10, 2))) == pa.decimal128(10, 2)
+    assert arrow_type(Column("n", Numeric(12))) == pa.decimal128(12, 0)
+    # unbounded or wider than decimal128: exact only as text
+    assert arrow_type(Column("n", Numeric())) is None
+    assert arrow_type(Column("n", Numeric(50, 2))) is None
+    aware = arrow_type(Column("t", DateTime(timezone=True)))
+    assert aware == pa.timestamp("us", tz="UTC")
+    assert arrow_type(Column("t", DateTime())) == pa.timestamp("us")
+    assert arrow_type(Column("i", Integer)) == pa.int64()
+    assert arrow_type(Column("u", UUID(as_uuid=True))) is None
+    assert arrow_type(Column("j", JSON)) is None
+    prices = Table(
+        "prices",
+        MetaData(),
+        Column("id", UUID(as_uuid=True), primary_key=True),
+        Column("amount", Numeric()),
+    )
+    writer = export.ArrowExport(select(prices))
+    assert writer.schema == pa.schema([("id", pa.string()), ("amount", pa.string())])
+    assert "CAST(anon_1.amount AS TEXT) AS amount" in sql(writer.statement)
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import Column, Integer, MetaData, Table
+
+from fusionserve.feeds import ChangeFeeds, authorize
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_overflow():
+    """A subscriber falling behind is marked instead of buffering"""
+    feeds = ChangeFeeds()
+    subscriber = feeds.subscribe("jobs", {})
+    for _ in range(subscriber.queue.maxsize + 1):
+        feeds.reset()
+    assert subscriber.overflowed
+    assert subscriber.queue.full()
+    feeds.unsubscribe(subscriber)
+    assert feeds.count() == 0
+
+
+def test_unwatched():
+    """Tables without a row trigger have no feed"""
+    table = Table("jobs", MetaData(), Column("id", Integer, primary_key=True))
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(authorize(table, "reader"))
+    assert e.value.status_code == 503
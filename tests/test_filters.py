@@ -0,0 +1,57 @@
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy.dialects import postgresql
+
+from fusionserve.filters import condition, parameters, parse
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def table():
+    return Table(
+        "books",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("author", String),
+        Column("price", Integer),
+    )
+
+
+def test_parse():
+    """Expressions differing only by values share the same tree"""
+    tree, values = parse("(author eq 'Fitz' or author eq 'O''Neil') and price lt 3")
+    other, _ = parse("(author eq 'Redmond' or author eq 'x') and price lt 10")
+    assert tree == other
+    assert values == ("Fitz", "O'Neil", "3")
+    for invalid in ["author eq", "author ~ 1", "price gt null", "(author eq 'a'"]:
+        with pytest.raises(HTTPException):
+            parse(invalid)
+
+
+def test_parse_limits():
+    """Deeply nested or very long expressions are refused"""
+    assert parse("(" * 32 + "price lt 3" + ")" * 32)[1] == ("3",)
+    for invalid in [
+        "(" * 3000 + "price lt 3" + ")" * 3000,
+        "not " * 3000 + "price lt 3",
+        " or ".join(["price lt 3"] * 1000),
+    ]:
+        with pytest.raises(HTTPException) as e:
+            parse(invalid)
+        assert e.value.status_code == 400
+
+
+def test_condition(table):
+    """Values are bound and converted to the column types"""
+    tree, values = parse("not startswith(author, '5%_') and price in (1, 2)")
+    assert parameters(tree, values, table) == {"where_0": "5/%/_", "where_1": [1, 2]}
+    sql = str(condition(tree, table).compile(dialect=postgresql.dialect()))
+    assert "NOT LIKE" in sql and "ESCAPE '/'" in sql and "IN" in sql
+    for invalid in ["price eq 'abc'", "missing eq 1", "contains(price, '1')"]:
+        tree, values = parse(invalid)
+        with pytest.raises(HTTPException):
+            parameters(tree, values, table)
@@ -0,0 +1,126 @@
+import asyncio
+
+from graphql import (
+    GraphQLArgument,
+    GraphQLField,
+    GraphQLInt,
+    GraphQLList,
+    GraphQLNonNull,
+    GraphQLObjectType,
+    GraphQLSchema,
+    parse,
+)
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.automap import automap_base
+
+from fusionserve import db, gql
+from fusionserve.config import settings
+from fusionserve.gql import Loader, check_limits, query_cost, type_name
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+Task = GraphQLObjectType("Task", {"id": GraphQLField(GraphQLInt)})
+Job = GraphQLObjectType(
+    "Job",
+    {
+        "id": GraphQLField(GraphQLInt),
+        "tasks": GraphQLField(
+            GraphQLNonNull(GraphQLList(GraphQLNonNull(Task))),
+            args={"limit": GraphQLArgument(GraphQLInt, default_value=10)},
+        ),
+    },
+)
+Query = GraphQLObjectType(
+    "Query",
+    {
+        "jobs": GraphQLField(
+            GraphQLList(Job),
+            args={"limit": GraphQLArgument(GraphQLInt, default_value=100)},
+        )
+    },
+)
+
+
+def test_query_cost():
+    """Objects cost one, times the limits of the lists containing them"""
+    document = parse(
+        "{ jobs(limit: 5) { id ...f } } fragment f on Job { tasks { id } }"
+    )
+    fragments = {"f": document.definitions[1]}
+    selection = document.definitions[0].selection_set
+    assert query_cost(selection, Query, fragments, {}) == (5 * (1 + 10), 3)
+    document = parse("query($l: Int) { jobs(limit: $l) { tasks(limit: 2) { id } } }")
+    selection = document.definitions[0].selection_set
+    assert query_cost(selection, Query, {}, {"l": 3}) == (3 * (1 + 2), 3)
+
+
+def test_check_limits(monkeypatch):
+    """Expensive queries and invalid limits are refused before running"""
+    monkeypatch.setattr(gql, "schema", GraphQLSchema(Query))
+    monkeypatch.setattr(settings, "graphql_max_cost", 2000)
+    assert not check_limits(parse("{ jobs { tasks { id } } }"), {})
+    assert check_limits(parse("{ jobs(limit: 1000) { tasks { id } } }"), {})
+    negative = "{ a: jobs(limit: -100000) { id } c: jobs(limit: 10) { id } }"
+    assert check_limits(parse(negative), {})
+    variable = parse("query($l: Int) { jobs(limit: $l) { id } }")
+    assert check_limits(variable, {"l": "abc"})
+    assert not check_limits(variable, {"l": 10})
+
+
+class FakeContext:
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    async def fetch(self, statement):
+        self.statements.append(statement)
+        return self.rows
+
+
+def test_loader():
+    """Keys loaded in the same tick are fetched in one query, up to the limit"""
+    metadata = MetaData()
+    Table("jobs", metadata, Column("id", Integer, primary_key=True))
+    tasks = Table(
+        "tasks",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("job_id", Integer, ForeignKey("jobs.id")),
+    )
+    context = FakeContext([{"id": 1, "job_id": 1}, {"id": 2, "job_id": 1}])
+    loader = Loader(context, tasks, [tasks.c.job_id], limit=2)
+
+    async def load():
+        return await asyncio.gather(
+            loader.load((1,)), loader.load((2,)), loader.load((1,))
+        )
+
+    first, second, again = asyncio.run(load())
+    assert len(context.statements) == 1
+    assert [row["id"] for row in first] == [1, 2] and first is again
+    assert second == []
+    sql = str(context.statements[0].compile(dialect=postgresql.dialect()))
+    assert "row_number() OVER (PARTITION BY tasks.job_id ORDER BY tasks.id)" in sql
+
+
+def test_type_names(monkeypatch):
+    """Tables named like a scalar, the root type or each other get unique types"""
+    taken = set(gql.RESERVED_NAMES)
+    assert type_name("job_type", taken) == "JobType"
+    assert type_name("Job_type", taken) == "JobTypeType"
+    assert type_name("job_type", taken) == "JobTypeType2"
+    metadata = MetaData()
+    for name in ("times", "queries", "jobs"):
+        Table(name, metadata, Column("id", Integer, primary_key=True))
+    base = automap_base(metadata=metadata)
+    base.prepare()
+    monkeypatch.setattr(db, "Base", base)
+    monkeypatch.setattr(db, "models_registry", dict.fromkeys(metadata.tables))
+    gql.build_schema()
+    assert gql.schema.get_type("TimeType").fields["id"].type is GraphQLInt
+    assert gql.schema.get_type("QueryType").fields.keys() == {"id"}
+    assert gql.schema.get_type("Job").fields.keys() == {"id"}
+    assert gql.schema.query_type.fields["time"].type.name == "TimeType"
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+
+from fusionserve.metrics import instrument, server_timing
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_server_timing():
+    """Setting the role is not counted as database time, nor pool waits as app"""
+    stats = {
+        "db": 0.030,
+        "pool": 0.005,
+        "identity": 0.010,
+        "statements": 2,
+        "cache": "miss",
+    }
+    assert server_timing(stats, 0.050) == (
+        "pool;dur=5.0, identity;dur=10.0, "
+        'db;dur=20.0;desc="2 statements", app;dur=15.0, total;dur=50.0, '
+        'cache;desc="miss"'
+    )
+
+
+def test_instrument_failed_statement():
+    """A failed statement leaves nothing behind on the pooled connection"""
+    engine = create_engine("sqlite://")
+    instrument(SimpleNamespace(sync_engine=engine))
+    with engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(DBAPIError):
+                conn.execute(text("SELECT * FROM missing"))
+        conn.execute(text("SELECT 1"))
+        assert not conn.info
@@ -0,0 +1,41 @@
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from fusionserve import db
+from fusionserve.config import settings
+from fusionserve.profiling import ProfileMiddleware
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+async def hello(request):
+    return PlainTextResponse("hello")
+
+
+def test_profile(tmp_path, monkeypatch):
+    """Only the requests asking for it, by the allowed roles, are profiled"""
+    app = Starlette(routes=[Route("/api/jobs/{id}", hello)])
+    app.add_middleware(ProfileMiddleware)
+    client = TestClient(app)
+    profile = {"X-Profile": "1"}
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path / "profiles"))
+    monkeypatch.setattr(settings, "profile_roles", [])
+    assert "x-profile" not in client.get("/api/jobs/1", headers=profile).headers
+
+    async def get_role(request):
+        return "admin"
+
+    monkeypatch.setattr(db, "get_role", get_role)
+    monkeypatch.setattr(settings, "profile_roles", ["admin"])
+    assert "x-profile" not in client.get("/api/jobs/1").headers
+    response = client.get("/api/jobs/1", headers=profile)
+    assert response.text == "hello"
+    name = response.headers["x-profile"]
+    assert "GET_api_jobs_1." in name and "/" not in name
+    assert [p.name for p in (tmp_path / "profiles").iterdir()] == [name]
+    monkeypatch.setattr(settings, "profile_roles", ["someone else"])
+    assert "x-profile" not in client.get("/api/jobs/1", headers=profile).headers
@@ -0,0 +1,134 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, String, Table
+
+from fusionserve import db, gql, reload, snapshot
+from fusionserve.config import settings
+from fusionserve.notify import listener
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_reload_loop(monkeypatch):
+    """DDL of the app schema is debounced into one reload, failures are survived"""
+    reloads = []
+    callbacks = {}
+
+    async def reload_routes(app):
+        reloads.append(app)
+        if len(reloads) == 1:
+            raise RuntimeError("reflection failed")
+
+    async def listen(channel, callback):
+        callbacks[channel] = callback
+
+    async def install_event_triggers():
+        pass
+
+    monkeypatch.setattr(db, "reload_routes", reload_routes)
+    monkeypatch.setattr(gql, "build_schema", lambda: None)
+    monkeypatch.setattr(reload, "install_event_triggers", install_event_triggers)
+    monkeypatch.setattr(listener, "listen", listen)
+    monkeypatch.setattr(listener, "on_reconnect", [])
+    monkeypatch.setattr(settings, "schema_reload_delay", 0.01)
+    monkeypatch.setattr(settings, "response_cache", False)
+    monkeypatch.setattr(settings, "change_feeds", False)
+
+    def ddl(schema: str):
+        payload = {"schema": schema, "object": f"{schema}.jobs"}
+        callbacks[reload.DDL_CHANNEL](json.dumps(payload))
+
+    async def run():
+        await reload.start("app")
+        try:
+            ddl("other")
+            await asyncio.sleep(0.05)
+            assert reloads == []
+            for _ in range(3):
+                ddl(settings.pg_app_schema)
+            await asyncio.sleep(0.05)
+            assert reloads == ["app"]
+            # the failed reload did not stop the loop
+            listener.on_reconnect[0]()
+            await asyncio.sleep(0.05)
+            assert reloads == ["app", "app"]
+        finally:
+            await reload.stop()
+
+    asyncio.run(run())
+
+
+def tables(metadata: MetaData, *names: str, queue: bool = False):
+    for name in names:
+        columns = [Column("id", Integer, primary_key=True)]
+        if name == "tasks":
+            columns.append(Column("job_id", Integer, ForeignKey("app_public.jobs.id")))
+        if name == "jobs" and queue:
+            columns.append(Column("queue", String))
+        Table(name, metadata, *columns, schema="app_public")
+    return metadata
+
+
+def test_reload_routes(monkeypatch):
+    """Changed tables and the tables related to them get new routes"""
+    monkeypatch.setattr(settings, "pg_app_schema", "app_public")
+    monkeypatch.setattr(settings, "schema_snapshot", False)
+    base, registry = db.build_registry(
+        tables(MetaData(), "jobs", "tasks", "queues", "workers")
+    )
+    monkeypatch.setattr(db, "Base", base)
+    monkeypatch.setattr(db, "models_registry", dict(registry))
+    monkeypatch.setattr(db, "routes_registry", {})
+    digests = {"": "enums", "jobs": "1", "tasks": "1", "queues": "1", "workers": "1"}
+    monkeypatch.setattr(db, "catalog_digests", digests)
+    app = FastAPI()
+    for name, item in registry.items():
+        db.routes_registry[name] = db.table_routes(app, name, item)
+    reflected = []
+
+    @asynccontextmanager
+    async def role_connection(role):
+        yield None
+
+    fingerprints = {"": "enums", "jobs": "2", "tasks": "1", "queues": "1"}
+
+    async def table_fingerprints(conn, schema):
+        return dict(fingerprints)
+
+    async def reflect(conn, metadata, only):
+        reflected.append(sorted(only))
+        return tables(metadata, *only, queue=True)
+
+    monkeypatch.setattr(db, "role_connection", role_connection)
+    monkeypatch.setattr(db, "reflect", reflect)
+    monkeypatch.setattr(snapshot, "table_fingerprints", table_fingerprints)
+    queues = db.routes_registry["queues"]
+    jobs, tasks = db.routes_registry["jobs"], db.routes_registry["tasks"]
+    asyncio.run(db.reload_routes(app))
+    # jobs changed, workers was dropped and tasks refers to jobs
+    assert reflected == [["jobs"]]
+    assert db.catalog_digests["jobs"] == "2"
+    assert db.routes_registry.keys() == {"jobs", "tasks", "queues"}
+    assert db.routes_registry["queues"] == queues
+    assert db.models_registry["queues"] is registry["queues"]
+    assert db.models_registry["tasks"] is not registry["tasks"]
+    assert "queue" in db.models_registry["jobs"].model.model_fields
+    routes = set(map(id, app.router.routes))
+    assert all(id(route) in routes for route in queues)
+    for name, old in (("jobs", jobs), ("tasks", tasks)):
+        assert not any(id(route) in routes for route in old)
+        assert all(id(route) in routes for route in db.routes_registry[name])
+    assert not any(route.path.startswith("/api/workers") for route in app.routes)
+    # nothing changed since
+    asyncio.run(db.reload_routes(app))
+    assert reflected == [["jobs"]]
+    # enum labels changed: any table may use them
+    fingerprints[""] = "enums 2"
+    asyncio.run(db.reload_routes(app))
+    assert reflected[-1] == ["jobs", "queues", "tasks"]
+    assert db.routes_registry["queues"] != queues
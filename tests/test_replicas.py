@@ -0,0 +1,75 @@
+import asyncio
+from types import SimpleNamespace
+
+from fusionserve import cache, db, replicas
+from fusionserve.config import settings
+from fusionserve.replicas import ReplicaSet, parse_lsn, read_engine, replica_set
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def replica(name: str, lsn: int, healthy: bool = True):
+    return SimpleNamespace(
+        name=name, lsn=lsn, healthy=healthy, read_engine=name, connections=lambda: 0
+    )
+
+
+def test_parse_lsn():
+    """LSNs compare by their position in the log"""
+    assert parse_lsn("0/0") == 0
+    assert parse_lsn("16/B374D848") == 0x16_B374D848
+    assert parse_lsn("1/0") > parse_lsn("0/FFFFFFFF")
+
+
+def test_pick():
+    """Only healthy replicas that replayed the requested LSN are used"""
+    replicas = ReplicaSet()
+    replicas.replicas = [replica("a", 100), replica("b", 50), replica("c", 200, False)]
+    assert replicas.pick(60).name == "a"
+    assert replicas.pick(150) is None
+    replica_set.replicas = replicas.replicas
+    try:
+        assert read_engine(SimpleNamespace(headers={"X-LSN": "0/64"})) == "a"
+        assert read_engine(SimpleNamespace(headers={"X-LSN": "0/C8"})) is (
+            db.read_engine
+        )
+    finally:
+        replica_set.replicas = []
+
+
+def test_check(monkeypatch):
+    """A replica with an unknown lag or a failing check is not used"""
+    replicas = ReplicaSet()
+    replicas.replicas = [replica("a", 0), replica("b", 0)]
+
+    async def status(r):
+        if r.name == "b":
+            raise RuntimeError("unexpected")
+        return "0/64", None
+
+    monkeypatch.setattr(replicas, "_status", status)
+    asyncio.run(replicas.check_all())
+    assert not any(r.healthy for r in replicas.replicas)
+    assert replicas.replicas[0].lsn == 100
+
+
+def test_settle(monkeypatch):
+    """Responses are held back after a change only when replicas serve reads"""
+    monkeypatch.setattr(cache.response_cache, "settle", 0.0)
+    monkeypatch.setattr(settings, "replica_max_lag", 5)
+    monkeypatch.setattr(settings, "replica_check_interval", 1)
+
+    async def run(addresses):
+        monkeypatch.setattr(settings, "pg_replicas", addresses)
+        replicas = ReplicaSet()
+        await replicas.start()
+        replicas._task.cancel()
+
+    monkeypatch.setattr(ReplicaSet, "check_all", lambda self: asyncio.sleep(0))
+    asyncio.run(run([]))
+    assert cache.response_cache.settle == 0.0
+    monkeypatch.setattr(replicas, "Replica", lambda address: replica(address, 0))
+    asyncio.run(run(["replica:5432"]))
+    assert cache.response_cache.settle == 6
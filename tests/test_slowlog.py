@@ -0,0 +1,31 @@
+from sqlalchemy import Integer, bindparam, select
+
+from fusionserve.config import settings
+from fusionserve.slowlog import SlowQueryLog
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_observe(monkeypatch):
+    """Slow executions add up by statement, fast ones are ignored"""
+    monkeypatch.setattr(settings, "slow_query_explain_interval", 0)
+    log = SlowQueryLog(2)
+    first = select(bindparam("a", type_=Integer))
+    second = select(bindparam("b", type_=Integer), bindparam("c", type_=Integer))
+    log.observe("jobs", "reader", first, {"a": 1}, settings.slow_query_threshold / 2)
+    assert not log.entries
+    log.observe("jobs", "reader", first, {"a": 1}, 2.0)
+    log.observe("jobs", "reader", first, {"a": 2}, 3.0)
+    log.observe("jobs", "reader", second, {"b": 1, "c": "x"}, 4.0)
+    top = [entry.as_dict() for entry in log.top(10)]
+    assert [(e["calls"], e["total_time"], e["max_time"]) for e in top] == [
+        (2, 5.0, 3.0),
+        (1, 4.0, 4.0),
+    ]
+    assert top[1]["parameters"] == {"b": "int", "c": "str"}
+    assert "$1" in top[0]["sql"]
+    log.observe("jobs", "writer", first, {"a": 1}, 2.0)
+    assert len(log.entries) == 2
+    assert [e.role for e in log.top(1)] == ["reader"]
@@ -0,0 +1,36 @@
+from sqlalchemy import Column, ForeignKey, MetaData, Table
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+
+from fusionserve import snapshot
+from fusionserve.config import settings
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def test_save_load(tmp_path, monkeypatch):
+    """Snapshots round trip and replace the stale ones"""
+    monkeypatch.setattr(settings, "schema_snapshot_dir", str(tmp_path))
+    metadata = MetaData(schema="app_public")
+    Table("jobs", metadata, Column("id", UUID, primary_key=True))
+    Table(
+        "tasks",
+        metadata,
+        Column("id", UUID, primary_key=True),
+        Column("job_id", UUID, ForeignKey("app_public.jobs.id")),
+        Column("payload", JSONB, comment="task input"),
+    )
+    assert snapshot.load("app_public", "old") is None
+    snapshot.save("app_public", "old", metadata)
+    snapshot.save("app_public", "new", metadata)
+    assert snapshot.load("app_public", "old") is None
+    loaded = snapshot.load("app_public", "new")
+    assert list(loaded.tables) == ["app_public.jobs", "app_public.tasks"]
+    tasks = loaded.tables["app_public.tasks"]
+    assert tasks.c.payload.comment == "task input"
+    assert isinstance(tasks.c.payload.type, JSONB)
+    assert [fk.column for fk in tasks.c.job_id.foreign_keys] == [
+        loaded.tables["app_public.jobs"].c.id
+    ]
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,48 @@
+from sqlalchemy import Column, Integer, MetaData, Table, select
+from sqlalchemy.dialects import postgresql
+
+from fusionserve import metrics
+from fusionserve.statements import Explain, StatementCache
+
+__author__ = "Marco Frassinelli"
+__copyright__ = "Marco Frassinelli"
+__license__ = "MIT"
+
+
+def counts(name: str):
+    return (
+        metrics.statement_cache_hits.labels(name)._value.get(),
+        metrics.statement_cache_misses.labels(name)._value.get(),
+    )
+
+
+def test_statement_cache():
+    """Statements are built once per table and shape, least recently used out"""
+    jobs = Table("jobs", MetaData(), Column("id", Integer, primary_key=True))
+    cache = StatementCache(2)
+    hits, misses = counts("jobs")
+    first = cache.get(jobs, "a", lambda: select(jobs))
+    assert cache.get(jobs, "a", lambda: select(jobs.c.id)) is first
+    assert counts("jobs") == (hits + 1, misses + 1)
+    cache.get(jobs, "b", lambda: select(jobs))
+    cache.get(jobs, "a", lambda: select(jobs))
+    cache.get(jobs, "c", lambda: select(jobs))
+    # b was the least recently used
+    assert list(cache.entries) == [(jobs, "a"), (jobs, "c")]
+    assert counts("jobs") == (hits + 2, misses + 3)
+    # a table reflected again is another table, even with the same name
+    reloaded = jobs.to_metadata(MetaData())
+    assert cache.get(reloaded, "a", lambda: select(reloaded)) is not first
+    cache.clear()
+    assert not cache.entries
+
+
+def test_explain():
+    """The plan of a select is asked with the same parameters"""
+    jobs = Table("jobs", MetaData(), Column("id", Integer, primary_key=True))
+    statement = select(jobs).where(jobs.c.id == 1)
+    sql = str(Explain(statement).compile(dialect=postgresql.dialect()))
+    assert sql.startswith("EXPLAIN (FORMAT JSON) SELECT jobs.id")
+    assert "WHERE jobs.id = %(id_1)s" in sql
+    sql = str(Explain(statement, analyze=True).compile(dialect=postgresql.dialect()))
+    assert sql.startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT")